@@ -8,74 +8,370 @@ Updated by Ola Ringdahl 204-09-11
 """
 
 
-import httplib, json, time, sys, random
-from math import sin,cos,pi,atan2,degrees,radians, sqrt, floor
-import matplotlib.pyplot as plt
+import httplib, json, time, sys, socket, threading, heapq, collections, os, zlib, struct, bisect, copy, Queue, argparse
+from math import sin,cos,pi,atan2,degrees,radians, sqrt, floor, ceil
+START_TIME = time.time() # reported by --startup
+try:
+    import numpy as np
+except ImportError: # numpy is only needed for the 'numpy' and 'tiled' gridmap backends
+    np = None
 
 
 HEADERS = {"Content-type": "application/json", "Accept": "text/json"}
+MRDS_URL = 'localhost:50000'
 
 class UnexpectedResponse(Exception): pass
 
+class lokarria():
+    '''
+    Keep-alive client for the Lokarria http interface.
+    Idle connections are kept in a small pool and reused, a request that fails
+    on a stale connection is retried once on a freshly opened one and the rest of
+    the pool, likely just as stale after a server restart, is closed.
+    '''
+    def __init__(self, url, timeout=2.0, pool_size=4):
+        self.host = url.replace('http://', '').rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.opened = 0 # connections created
+        self.reused = 0 # requests served by an already open connection
+        self.recorder = None # sensor_log receiving every pose, scan and speed command
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self, fresh=False):
+        '''(connection, pooled): an idle pooled connection, or a new one when fresh is set or the pool is empty'''
+        with self._lock:
+            if self._idle and not fresh:
+                return self._idle.pop(), True
+            self.opened += 1
+        return httplib.HTTPConnection(self.host, timeout=self.timeout), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, path, body=None, headers={}, timeout=None):
+        '''Send one request and return (status, body), the response is always read to the end'''
+        fresh = False
+        while True:
+            conn, pooled = self._acquire(fresh)
+            conn.timeout = self.timeout if timeout is None else timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not pooled:
+                    raise
+                self.close() # the other idle connections went stale the same way
+                fresh = True
+                continue
+            if pooled:
+                with self._lock:
+                    self.reused += 1
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return response.status, data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        return {'opened': self.opened, 'reused': self.reused}
+
+    def post_speed(self, angularSpeed, linearSpeed, timeout=None):
+        params = json.dumps({'TargetAngularSpeed':angularSpeed,'TargetLinearSpeed':linearSpeed})
+        status, data = self.request('POST', '/lokarria/differentialdrive', params, HEADERS, timeout)
+        if status != 204:
+            raise UnexpectedResponse(status, data)
+        if self.recorder:
+            self.recorder.speed(time.time(), angularSpeed, linearSpeed)
+        return status
+
+    def get_json(self, path, timeout=None):
+        status, data = self.request('GET', path, timeout=timeout)
+        if status != 200:
+            raise UnexpectedResponse(status, data)
+        return json.loads(data)
+
+    def get_laser(self, timeout=None):
+        laser = self.get_json('/lokarria/laser/echoes', timeout)
+        if self.recorder:
+            self.recorder.laser(time.time(), laser)
+        return laser
+
+    def get_laser_properties(self, timeout=None):
+        properties = self.get_json('/lokarria/laser/properties', timeout)
+        if self.recorder:
+            self.recorder.properties(time.time(), properties)
+        return properties
+
+    def get_pose(self, timeout=None):
+        pose = self.get_json('/lokarria/localization', timeout)
+        if self.recorder:
+            self.recorder.pose(time.time(), pose)
+        return pose
+
+    def get_snapshot(self, timeout=None):
+        '''Fetch pose and laser echoes concurrently and stamp them with one time'''
+        result = {}
+        def fetch_laser():
+            try:
+                result['laser'] = self.get_json('/lokarria/laser/echoes', timeout)
+            except Exception as e:
+                result['error'] = e
+        t0 = time.time()
+        worker = threading.Thread(target=fetch_laser)
+        worker.start()
+        try:
+            pose = self.get_json('/lokarria/localization', timeout)
+        finally:
+            worker.join()
+        if 'error' in result:
+            raise result['error']
+        snap = snapshot((t0 + time.time()) / 2, pose, result['laser'])
+        if self.recorder:
+            self.recorder.pose(snap.timestamp, pose)
+            self.recorder.laser(snap.timestamp, snap.laser)
+        return snap
+
+class snapshot():
+    '''Pose and laser scan of one control tick, timestamped at the middle of the fetch'''
+    def __init__(self, timestamp, pose, laser):
+        self.timestamp = timestamp
+        self.pose = pose
+        self.laser = laser
+        self.echoes = laser['Echoes']
+        self.pose2d = pose2d.from_lokarria(pose)
+
+LOG_MAGIC = b'MLOG\x01'
+LOG_POSE, LOG_LASER, LOG_SPEED, LOG_PROPERTIES = 1, 2, 3, 4
+
+class sensor_log():
+    '''
+    Append-only binary log of everything exchanged with the robot.
+    After the file magic each record is a type byte and a double timestamp followed by
+    pose: 7 doubles (X, Y, Z, W, QX, QY, QZ), laser: uint16 count and float32 echoes,
+    speed: 2 doubles (angular, linear), properties: uint32 length and JSON text.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(LOG_MAGIC)
+        self._lock = threading.Lock()
+
+    def write(self, kind, timestamp, payload):
+        with self._lock:
+            self.file.write(struct.pack('<Bd', kind, timestamp) + payload)
+
+    def pose(self, timestamp, pose):
+        p = pose['Pose']['Position']; q = pose['Pose']['Orientation']
+        self.write(LOG_POSE, timestamp, struct.pack('<7d', p['X'], p['Y'], p['Z'], q['W'], q['X'], q['Y'], q['Z']))
+
+    def laser(self, timestamp, laser):
+        echoes = laser['Echoes']
+        self.write(LOG_LASER, timestamp, struct.pack('<H%df' % len(echoes), len(echoes), *echoes))
+
+    def speed(self, timestamp, angularSpeed, linearSpeed):
+        self.write(LOG_SPEED, timestamp, struct.pack('<2d', angularSpeed, linearSpeed))
+
+    def properties(self, timestamp, properties):
+        text = json.dumps(properties).encode('utf-8')
+        self.write(LOG_PROPERTIES, timestamp, struct.pack('<I', len(text)) + text)
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+def log_records(data, path):
+    '''
+    Yield (type, timestamp, offset) for every complete record in the bytes of the sensor log at path,
+    offset being where the record payload starts in data. A truncated last record is skipped.
+    '''
+    if not data.startswith(LOG_MAGIC):
+        raise ValueError('%s is not a sensor log' % path)
+    head = struct.Struct('<Bd')
+    i = len(LOG_MAGIC)
+    while i + head.size <= len(data):
+        kind, timestamp = head.unpack_from(data, i)
+        i += head.size
+        if kind == LOG_POSE:
+            size = 56
+        elif kind == LOG_LASER:
+            if i + 2 > len(data):
+                return
+            size = 2 + 4 * struct.unpack_from('<H', data, i)[0]
+        elif kind == LOG_SPEED:
+            size = 16
+        elif kind == LOG_PROPERTIES:
+            if i + 4 > len(data):
+                return
+            size = 4 + struct.unpack_from('<I', data, i)[0]
+        else:
+            raise ValueError('Corrupt sensor log %s at byte %d' % (path, i))
+        if i + size > len(data):
+            return
+        yield kind, timestamp, i
+        i += size
+
+def read_log(path):
+    '''
+    Yield (type, timestamp, data) for every complete record of a sensor log, pose and laser data in
+    the dict layout Lokarria returns, speed as an (angular, linear) pair. A truncated last record is skipped.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    for kind, timestamp, i in log_records(data, path):
+        if kind == LOG_POSE:
+            x, y, z, w, qx, qy, qz = struct.unpack_from('<7d', data, i)
+            yield kind, timestamp, {'Pose': {'Position': {'X': x, 'Y': y, 'Z': z},
+                                             'Orientation': {'W': w, 'X': qx, 'Y': qy, 'Z': qz}}}
+        elif kind == LOG_LASER:
+            n = struct.unpack_from('<H', data, i)[0]
+            yield kind, timestamp, {'Echoes': list(struct.unpack_from('<%df' % n, data, i + 2))}
+        elif kind == LOG_SPEED:
+            yield kind, timestamp, struct.unpack_from('<2d', data, i)
+        else:
+            n = struct.unpack_from('<I', data, i)[0]
+            yield kind, timestamp, json.loads(data[i + 4:i + 4 + n].decode('utf-8'))
+
+class log_client():
+    '''
+    Stands in for the lokarria client during replay.
+    Each snapshot pairs a recorded laser scan with the latest pose before it, speed commands are ignored.
+    Raises EOFError when the log is exhausted.
+    '''
+    def __init__(self, path):
+        self.records = list(read_log(path))
+        self.position = 0
+        self.pose = None
+        self.laser_properties = None
+        for kind, timestamp, data in self.records:
+            if kind == LOG_PROPERTIES:
+                self.laser_properties = data
+                break
+
+    def stats(self):
+        return {'records': len(self.records), 'replayed': self.position}
+
+    def post_speed(self, angularSpeed, linearSpeed, timeout=None):
+        return 204
+
+    def get_laser_properties(self, timeout=None):
+        if self.laser_properties is None:
+            raise UnexpectedResponse('sensor log has no laser properties')
+        return self.laser_properties
+
+    def get_snapshot(self, timeout=None):
+        while self.position < len(self.records):
+            kind, timestamp, data = self.records[self.position]
+            self.position += 1
+            if kind == LOG_POSE:
+                self.pose = data
+            elif kind == LOG_LASER and self.pose is not None:
+                return snapshot(timestamp, self.pose, data)
+        raise EOFError('end of sensor log')
+
+    def get_pose(self, timeout=None):
+        return self.get_snapshot().pose
+
+    def get_laser(self, timeout=None):
+        return self.get_snapshot().laser
+
+def replay(path, grids, plan=True, plan_level=0):
+    '''
+    Feed a sensor log through robot.scan_and_update, and the frontier search and planner when plan
+    is set, as fast as the CPU allows. Returns the replaying robot.
+    '''
+    bot = robot(log_client(path))
+    bot.plan_level = plan_level
+    while True:
+        try:
+            bot.scan_and_update(grids)
+        except EOFError:
+            break
+        if plan and bot.find_target(grids) is not None:
+            bot.search_path(grids)
+    return bot
+
+_client = None
+
+def default_client():
+    '''Shared client for the module level functions, rebuilt when MRDS_URL changes'''
+    global _client
+    if _client is None or _client.host != MRDS_URL.replace('http://', '').rstrip('/'):
+        _client = lokarria(MRDS_URL)
+    return _client
+
 def postSpeed(angularSpeed,linearSpeed):
     """Sends a speed command to the MRDS server"""
-    mrds = httplib.HTTPConnection(MRDS_URL)
-    params = json.dumps({'TargetAngularSpeed':angularSpeed,'TargetLinearSpeed':linearSpeed})
-    mrds.request('POST','/lokarria/differentialdrive',params,HEADERS)
-    response = mrds.getresponse()
-    status = response.status
-    #response.close()
-    if status == 204:
-        return response
-    else:
-        raise UnexpectedResponse(response)
+    return default_client().post_speed(angularSpeed, linearSpeed)
 
 def getLaser():
     """Requests the current laser scan from the MRDS server and parses it into a dict"""
-    mrds = httplib.HTTPConnection(MRDS_URL)
-    mrds.request('GET','/lokarria/laser/echoes')
-    response = mrds.getresponse()
-    if (response.status == 200):
-        laserData = response.read()
-        response.close()
-        return json.loads(laserData)
-    else:
-        return response
+    return default_client().get_laser()
     
 def getLaserAngles():
     """Requests the current laser properties from the MRDS server and parses it into a dict"""
-    mrds = httplib.HTTPConnection(MRDS_URL)
-    mrds.request('GET','/lokarria/laser/properties')
-    response = mrds.getresponse()
-    if (response.status == 200):
-        laserData = response.read()
-        response.close()
-        properties = json.loads(laserData)
-        beamCount = int((properties['EndAngle']-properties['StartAngle'])/properties['AngleIncrement'])
-        a = properties['StartAngle']#+properties['AngleIncrement']
-        angles = []
-        while a <= properties['EndAngle']:
-            angles.append(a)
-            a+=pi/180 #properties['AngleIncrement']
-        #angles.append(properties['EndAngle']-properties['AngleIncrement']/2)
-        return angles
-    else:
-        raise UnexpectedResponse(response)
+    return laser_geometry(default_client().get_laser_properties()).angles
 
 def getPose():
     """Reads the current position and orientation from the MRDS"""
-    mrds = httplib.HTTPConnection(MRDS_URL)
-    mrds.request('GET','/lokarria/localization')
-    response = mrds.getresponse()
-    if (response.status == 200):
-        poseData = response.read()
-        response.close()
-        return json.loads(poseData)
-    else:
-        return UnexpectedResponse(response)
+    return default_client().get_pose()
+
+def getSnapshot():
+    """Reads pose and laser scan from the MRDS in parallel"""
+    return default_client().get_snapshot()
+
+class laser_geometry():
+    '''
+    Beam layout of the laser, built once from /lokarria/laser/properties.
+    Keeps the beam angles and unit vectors relative to the robot heading.
+    '''
+    def __init__(self, properties, beams=None):
+        self.properties = properties
+        self.start = properties['StartAngle']
+        self.end = properties['EndAngle']
+        if beams is None:
+            beams = int(round((self.end - self.start) / properties['AngleIncrement'])) + 1
+        self.count = beams
+        self.increment = (self.end - self.start) / (beams - 1)
+        self.angles = [self.start + i * self.increment for i in range(beams)]
+        self.cos = [cos(a) for a in self.angles]
+        self.sin = [sin(a) for a in self.angles]
+
+    def index(self, angle):
+        '''Index of the beam closest to angle (radians, robot frame), None outside the field of view'''
+        i = int(round((angle - self.start) / self.increment))
+        if i < 0 or i >= self.count:
+            return None
+        return i
+
+    def sector(self, angle, half_width):
+        '''Beam indices within half_width (radians) of angle, empty outside the field of view'''
+        i = self.index(angle)
+        if i is None:
+            return []
+        n = int(round(half_width / self.increment))
+        return range(max(i - n, 0), min(i + n + 1, self.count))
 
 def bearing(q):
-    return rotate(q,{'X':1.0,'Y':0.0,"Z":0.0})
+    """The X axis rotated by q, same as rotate(q, X axis) without the intermediate quaternions"""
+    w = q['W']; x = q['X']; y = q['Y']; z = q['Z']
+    return {'X': w * w + x * x - y * y - z * z, 'Y': 2 * (x * y + w * z), 'Z': 2 * (x * z - w * y)}
 
 def rotate(q,v):
     return vector(qmult(qmult(q,quaternion(v)),conjugate(q)))
@@ -111,28 +407,167 @@ def getBearing():
     """Returns the XY Orientation as a bearing unit vector"""
     return bearing(getPose()['Pose']['Orientation'])
 
+def quaternion_yaw(w, x, y, z):
+    """Heading in radians of the X axis rotated by the unit quaternion (w, x, y, z), in the XY plane"""
+    return atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+
+def yaw_array(orientations):
+    """Headings in radians of an N x 4 array of W,X,Y,Z unit quaternions"""
+    q = np.asarray(orientations, dtype=float)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    return np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+
+class pose2d(object):
+    '''Position in metres and heading in radians of the robot in the map plane'''
+    __slots__ = ('x', 'y', 'yaw')
+
+    def __init__(self, x, y, yaw):
+        self.x = x
+        self.y = y
+        self.yaw = yaw
+
+    @classmethod
+    def from_lokarria(cls, pose):
+        '''Pose of a /lokarria/localization reply'''
+        p = pose['Pose']['Position']; q = pose['Pose']['Orientation']
+        return cls(p['X'], p['Y'], quaternion_yaw(q['W'], q['X'], q['Y'], q['Z']))
+
+    def heading(self):
+        '''Yaw in degrees, -180 to 180'''
+        return degrees(self.yaw)
+
+    def __repr__(self):
+        return 'pose2d(%r, %r, %r)' % (self.x, self.y, self.yaw)
+
+def read_poses(path):
+    '''
+    Timestamps, N x 2 X,Y positions and headings in radians of all pose records of a sensor log,
+    as arrays. Positions go to grid cells with pos2coor_array.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    body = struct.Struct('<7d')
+    rows = [(timestamp,) + body.unpack_from(data, i) for kind, timestamp, i in log_records(data, path) if kind == LOG_POSE]
+    table = np.array(rows, dtype=float).reshape(-1, 8)
+    return table[:, 0], table[:, 1:3], yaw_array(table[:, 4:8])
+
 def pos2coor(position,gridsmap):
     """Convert Position to coordinate on map grid"""
-    coordinates = [int(floor((gridsmap.upper_right_y - position[1]) * 2)), int(floor((position[0] - gridsmap.lower_left_x) * 2))]
+    coordinates = [int(floor((gridsmap.upper_right_y - position[1]) / gridsmap.resolution)), int(floor((position[0] - gridsmap.lower_left_x) / gridsmap.resolution))]
+    return coordinates
+
+def pos2coor_array(points,gridsmap):
+    """Convert an N x 2 array of X,Y positions to an N x 2 array of row,column coordinates"""
+    points = np.asarray(points, dtype=float)
+    coordinates = np.empty(points.shape, dtype=np.intp)
+    coordinates[:, 0] = np.floor((gridsmap.upper_right_y - points[:, 1]) / gridsmap.resolution)
+    coordinates[:, 1] = np.floor((points[:, 0] - gridsmap.lower_left_x) / gridsmap.resolution)
     return coordinates
 
 def coor2pos(coordinates,gridmap):
-    '''convert coordinates to X,Y position. Assume point is the centre of the coordinate grid'''
-    position = [float(coordinates[1] - abs(gridmap.lower_left_x) * 2) / 2 , float(gridmap.upper_right_y * 2 - coordinates[0]) / 2]
+    '''convert coordinates to X,Y position of the upper left cell corner, fractional coordinates are allowed'''
+    position = [gridmap.lower_left_x + coordinates[1] * gridmap.resolution, gridmap.upper_right_y - coordinates[0] * gridmap.resolution]
     return position
 
+def trace_rays(origin, ends, shape):
+    '''
+    Traverse all beams of a scan in one batch.
+    Returns the flat indices (into a map of the given shape) of the cells between origin and each
+    end point, the origin included and the end points excluded, one entry per beam crossing a cell.
+    '''
+    ends = np.asarray(ends, dtype=np.intp)
+    delta_r = ends[:, 0] - origin[0]
+    delta_c = ends[:, 1] - origin[1]
+    steps = np.maximum(np.abs(delta_r), np.abs(delta_c))
+    total = steps.sum()
+    if total == 0:
+        return np.empty(0, dtype=np.intp)
+    beam = np.repeat(np.arange(len(steps)), steps)
+    j = np.arange(total) - np.repeat(np.cumsum(steps) - steps, steps) # step index along each beam
+    frac = j / steps[beam].astype(float)
+    rows = origin[0] + np.rint(frac * delta_r[beam]).astype(np.intp)
+    cols = origin[1] + np.rint(frac * delta_c[beam]).astype(np.intp)
+    np.clip(rows, 0, shape[0] - 1, out=rows)
+    np.clip(cols, 0, shape[1] - 1, out=cols)
+    return rows * shape[1] + cols
+
+class control_loop():
+    '''
+    Fixed-rate scheduler. run calls step once per period until it returns False and sleeps away
+    what is left of each period. A tick that ends past its deadline counts as a miss, the schedule
+    then restarts from now instead of bursting to catch up.
+    '''
+    def __init__(self, rate=10.0, clock=time.time, sleep=time.sleep):
+        self.period = 1.0 / rate
+        self.clock = clock
+        self.sleep = sleep
+        self.ticks = 0
+        self.misses = 0 # ticks that overran their deadline
+        self.worst = 0.0 # longest overrun in seconds
+        self.on_miss = None # called with the tick number and overrun of every miss
+
+    def run(self, step):
+        deadline = self.clock() + self.period
+        while step():
+            self.ticks += 1
+            now = self.clock()
+            if now > deadline:
+                self.misses += 1
+                self.worst = max(self.worst, now - deadline)
+                if self.on_miss is not None:
+                    self.on_miss(self.ticks, now - deadline)
+                deadline = now + self.period
+            else:
+                self.sleep(deadline - now)
+                deadline += self.period
+        self.ticks += 1
+
+    def stats(self):
+        return {'ticks': self.ticks, 'misses': self.misses, 'worst_ms': round(self.worst * 1000, 1)}
+
 class robot():
-    def __init__(self):
+    def __init__(self, client=None):
+        self.client = client or default_client() # Lokarria connection of this robot
+        self.pose = None # pose2d of the current snapshot
         self.position = [] # X,Y position
         self.coordinate = [] # Row Column coordinate in grid map
         self.speed = [] # Angular and Linear speed
         self.orientation = [] # Robot orientation angle in original frame in degrees
         self.target = [] # coordinate of target point
         self.scan_data = [] # From right most to left most scan boundary points position 
+        self.snapshot = None # Sensor snapshot of the current control tick
+        self.laser = None # laser_geometry, fetched from the server on the first scan
+        self.sleep = time.sleep # waits between control ticks, replaced when the simulation runs faster than real time
+        self.clock = time.time # control clock, scaled along with sleep
+        self.rate = 10.0 # control ticks per second while following a path
+        self.loop = None # control_loop, created on the first follow_path
+        self.max_speed = 1.0 # m/s
+        self.max_turn = 1.0 # rad/s
+        self.clearance = 0.3 # metres kept free ahead while driving
+        self.step_timeout = 10.0 # seconds allowed to reach the next block
+        self.skipped = set() # targets given up without moving, left out until the robot moves again
+        self.pipeline = None # map_pipeline integrating scans on its own threads, None integrates in sense
+        self.fleet = None # fleet sharing the map and handing out targets
+        self.plan_level = 0 # pyramid level for frontier search and planning with coarse_to_fine, 0 plans on blocks only
+        # scan gating: a snapshot is integrated in full once the robot moved gate_distance metres or turned
+        # gate_angle degrees since the last full scan, otherwise every gate_interval seconds only the beams
+        # whose range changed by gate_range metres are. Set gate_distance to 0 to integrate every snapshot.
+        self.gate_distance = 0.25
+        self.gate_angle = 10.0
+        self.gate_interval = 1.0
+        self.gate_range = 0.1
+        self.scans_integrated = 0 # snapshots integrated in full
+        self.scans_partial = 0 # snapshots integrated for the changed beams only
+        self.scans_skipped = 0 # snapshots not integrated
+        self._gate = None # position, orientation, timestamp and ranges of the last integrated scan
     
-    def get_position(self):
-        pos = getPose()
-        self.position = [pos['Pose']['Position']['X'], pos['Pose']['Position']['Y']]
+    def get_pose(self, snap=None):
+        self.pose = snap.pose2d if snap else pose2d.from_lokarria(self.client.get_pose())
+        return self.pose
+
+    def get_position(self, snap=None):
+        pose = self.get_pose(snap)
+        self.position = [pose.x, pose.y]
         return self.position
     
     def get_coor(self, grids):
@@ -140,15 +575,22 @@ class robot():
         return self.coordinate
     
     def set_speed(self,a,l):
-        postSpeed(a, l)
+        self.client.post_speed(a, l)
         self.speed = [a,l]
         return self.speed
     
-    def get_orientation(self):
-        orien_vector = getBearing()
-        self.orientation = degrees(atan2(orien_vector['Y'],orien_vector['X']))
+    def get_orientation(self, snap=None):
+        self.orientation = self.get_pose(snap).heading()
         return self.orientation
     
+    def get_laser_geometry(self, beams=None):
+        if self.laser is None:
+            self.laser = laser_geometry(self.client.get_laser_properties())
+        if beams is not None and beams != self.laser.count:
+            # echo count disagrees with the reported increment, spread the beams over the field of view
+            self.laser = laser_geometry(self.laser.properties, beams)
+        return self.laser
+
     def set_target(self,r,c):
         self.target = [r,c]
     
@@ -166,16 +608,17 @@ class robot():
         self.set_speed(0, 0)
         '''
         
-        distance = getLaser()['Echoes']
+        distance = self.snapshot.echoes
+        laser = self.get_laser_geometry(len(distance))
         p = self.position
         right_avg = 0
-        for i in range(40, 51):
+        for i in laser.sector(-pi / 2, radians(5)):
             right_avg += distance[i] / 10
         forward_avg = 0
-        for i in range(130, 141):
+        for i in laser.sector(0, radians(5)):
             forward_avg += distance[i] / 10
         left_avg = 0
-        for i in range(220, 231):
+        for i in laser.sector(pi / 2, radians(5)):
             left_avg += distance[i] / 10
         
         # Check obstacles
@@ -187,7 +630,7 @@ class robot():
             self.left_wall = True
         else:
             self.left_wall = False
-        if forward_avg < 4 or min([distance[i] for i in range(132,139)]) < 4 :
+        if forward_avg < 4 or min([distance[i] for i in laser.sector(0, radians(3))] or [4]) < 4 :
             self.forward_wall = True
         else:
             self.forward_wall = False 
@@ -224,23 +667,41 @@ class robot():
                 self.right_wall = True
         
         #print 'Front :', self.forward_wall, forward_avg, 'Right :',self.right_wall, right_avg ,'Left :', self.left_wall, left_avg, 'Position: ', p,self.orientation
-        beta = self.get_orientation() - 135 
+        # rotate the beam unit vectors by the robot heading
+        ch = cos(radians(self.orientation))
+        sh = sin(radians(self.orientation))
+        if grids.vectorized:
+            d = np.asarray(distance, dtype=float)
+            ux = np.asarray(laser.cos); uy = np.asarray(laser.sin)
+            self.scan_data = np.column_stack((d * (ch * ux - sh * uy) + p[0], d * (sh * ux + ch * uy) + p[1]))
+            return self.scan_data
         self.scan_data = []
-        for i in range(271):
-            point = [distance[i] * cos(radians(beta)) + p[0] , distance[i] * sin(radians(beta)) + p[1]]
-            beta += 1
+        for i in range(laser.count):
+            ux = laser.cos[i]; uy = laser.sin[i]
+            point = [distance[i] * (ch * ux - sh * uy) + p[0] , distance[i] * (sh * ux + ch * uy) + p[1]]
             self.scan_data.append(point)
         return self.scan_data
     
-    def update_map(self,grids):
+    def update_map(self, grids, beams=None):
+        '''Integrate scan_data into the map, only the beams listed in beams when given'''
+        margin = grids.resolution / 5 # keeps clamped points inside the border cells
+        if grids.vectorized:
+            scan_data = self.scan_data if beams is None else self.scan_data[beams]
+            points = np.empty(scan_data.shape)
+            np.clip(scan_data[:, 0], grids.lower_left_x, grids.upper_right_x - margin, out=points[:, 0])
+            np.clip(scan_data[:, 1], grids.lower_left_y + margin, grids.upper_right_y, out=points[:, 1])
+            scan_range = np.vstack((pos2coor_array(points, grids), self.coordinate))
+            grids.update(scan_range)
+            self.scan_boundary = scan_range
+            return scan_range
         scan_range = []
-        for point in self.scan_data:
+        for point in (self.scan_data if beams is None else [self.scan_data[i] for i in beams]):
             if point[0] <= grids.lower_left_x:
                 point[0] = grids.lower_left_x
             elif point[0] >= grids.upper_right_x:
-                point[0] = grids.upper_right_x - 0.1
+                point[0] = grids.upper_right_x - margin
             if point[1] <= grids.lower_left_y:
-                point[1] = grids.lower_left_y + 0.1
+                point[1] = grids.lower_left_y + margin
             elif point[1] >= grids.upper_right_y:
                 point[1] = grids.upper_right_y
             scan_range.append(pos2coor(point, grids))
@@ -254,130 +715,710 @@ class robot():
         Stop then scan and update 
         '''
         self.set_speed(0, 0)
-        self.get_position()
+        if self.pipeline is not None:
+            self.pipeline.sync()
+        self.sense(grids)
+
+    def sense(self, grids):
+        '''
+        Take a snapshot and integrate it into the map, without stopping.
+        With a pipeline the newest snapshot of its sensor thread is used and integration is left to it.
+        '''
+        if self.pipeline is not None:
+            self.snapshot = self.pipeline.newest()
+            self.get_laser_geometry(len(self.snapshot.echoes))
+        else:
+            self.snapshot = self.client.get_snapshot()
+        self.get_position(self.snapshot)
         self.get_coor(grids)
-        self.get_orientation()
-        self.scan(grids)
-        self.update_map(grids)
+        self.get_orientation(self.snapshot)
+        if self.pipeline is None:
+            beams = self.gate()
+            if beams is not None:
+                with grids.lock:
+                    self.scan(grids)
+                    self.update_map(grids, beams or None)
+
+    def gate(self):
+        '''
+        Decide how much of the current snapshot to integrate: [] for all beams, a list of beam numbers
+        for the beams that changed while the robot stands still, None to skip the snapshot.
+        '''
+        snap = self.snapshot
+        last = self._gate
+        if last is not None and len(last[4]) == len(snap.echoes):
+            x, y, heading, timestamp, ranges = last
+            turned = abs((self.orientation - heading + 180) % 360 - 180)
+            if sqrt((self.position[0] - x) ** 2 + (self.position[1] - y) ** 2) < self.gate_distance and turned < self.gate_angle:
+                if snap.timestamp - timestamp < self.gate_interval:
+                    self.scans_skipped += 1
+                    return None
+                echoes = snap.echoes
+                beams = [i for i in range(len(echoes)) if abs(echoes[i] - ranges[i]) > self.gate_range]
+                self._gate = (x, y, heading, snap.timestamp, ranges)
+                if not beams:
+                    self.scans_skipped += 1
+                    return None
+                for i in beams:
+                    ranges[i] = echoes[i]
+                self.scans_partial += 1
+                return beams
+        self._gate = (self.position[0], self.position[1], self.orientation, snap.timestamp, list(snap.echoes))
+        self.scans_integrated += 1
+        return []
+
+    def gate_stats(self):
+        return {'integrated': self.scans_integrated, 'partial': self.scans_partial, 'skipped': self.scans_skipped}
+
+    def map_view(self, grids):
+        '''The map planners should read, the latest published version when a pipeline is running'''
+        return grids if self.pipeline is None else self.pipeline.view
+
+    def planning_lock(self, grids):
+        '''
+        Lock to hold while planning on map_view: grids.lock when planners read grids itself, none
+        when they read a published pipeline view, which no thread changes.
+        '''
+        return grids.lock if self.pipeline is None else UNLOCKED
         
+    def obstacle_ahead(self, heading, limit=4):
+        '''
+        Check the beams within 5 degrees of a heading (in degrees, map frame) in the current snapshot.
+        Returns None when the heading is outside the laser field of view.
+        '''
+        rel = (heading - self.orientation + 180) % 360 - 180
+        beams = self.laser.sector(radians(rel), radians(5))
+        if len(beams) < 2 * int(round(radians(5) / self.laser.increment)) + 1:
+            return None
+        return min([self.snapshot.echoes[i] for i in beams]) < limit
+
     def find_target(self,grids):
         '''
-        Find a target point in a never been block to move, return the coordinate of that point
-        '''
-        choices = []
-        for point in self.scan_boundary:
-            point_block = (point[0] // 2, point[1] // 2)
-            print point,point_block
-            if grids.check_unkown(point_block):
-                if point_block not in choices:
-                    if not grids.block_occupancy(point_block):
-                        choices.append(point_block)
-        choices.sort()
-        
-        self.target = random.choice(choices)
+        Pick the nearest reachable frontier block as target, the path to it is kept in self.path.
+        Returns the target block, None once no frontier can be reached.
+        In a fleet the targets of the other robots and the blocks around them are left out.
+        '''
+        exclude = self.skipped
+        if self.fleet is not None:
+            with grids.lock:
+                exclude = exclude | self.fleet.reserved(self)
+        with self.planning_lock(grids):
+            self.target, self.path = self.map_view(grids).nearest_frontier(grids.block_of(self.coordinate), exclude,
+                                                                           level=self.plan_level)
+        if self.fleet is not None:
+            with grids.lock:
+                self.fleet.claims[self] = self.target
         return self.target
     
     def search_path(self,grids):
         '''
-        Wavefront path planning 
         Generate a path from current position to target position
         plan path on a larger scale block map
         '''
-        current_block = (self.coordinate[0] // 2, self.coordinate[1] // 2)
-        self.path = grids.search_path(current_block, self.target)
+        planner = coarse_to_fine(self.plan_level) if self.plan_level > 0 else None
+        with self.planning_lock(grids):
+            self.path = self.map_view(grids).search_path(grids.block_of(self.coordinate), self.target, planner)
         return self.path
     
     def follow_path(self, grids):
         '''
-        Follow the path from current point to target point
+        Follow the path from current point to target point under closed-loop control.
+        Every tick of self.loop integrates a fresh snapshot while the robot keeps moving, re-checks the
+        next block and the beams ahead, and steers towards the next block centre from the measured pose.
+        Stops at the target, when the way is blocked or when a block is not reached within step_timeout.
+        Returns the number of path blocks reached.
         '''
-        for i in range(1, len(self.path)):
-            self.scan_and_update(grids)
-            if grids.block_occupancy(self.path[i]):
-                break
-            block_centre = coor2pos(grids.block_center(self.path[i]) , grids)
-            angle = atan2(block_centre[1] - self.position[1] , block_centre[0] - self.position[0])
-            #print 'angle :', degrees(angle)
-            distance = sqrt((block_centre[0] - self.position[0])**2 + (block_centre[1] - self.position[1])**2 )
-            print 'Current Position:', self.position, 'Heading to: ', self.path[i],' at ', block_centre
-            if angle > radians(self.orientation):
-                t = angle - radians(self.orientation)
-                self.set_speed(0.5, 0)
-                time.sleep(t * 2)
-            else:
-                self.set_speed(-0.5, 0)
-                t = radians(self.orientation) - angle
-                time.sleep(t * 2)
-            self.set_speed(0, 0)
-            d = getLaser()['Echoes']
-            b = False
-            for i in range(130,141):
-                if d[i] < 4:
-                    b = True
-            if b == True:
-                break    
-            self.set_speed(0, 1)
-            time.sleep(distance)
-            self.set_speed(0, 0)
-            grids.show()
-        self.set_speed(0, 0)   
+        if self.loop is None:
+            self.loop = control_loop(self.rate, self.clock, self.sleep)
+        state = {'step': 1, 'since': self.clock()}
+        def tick():
+            self.sense(grids)
+            path = self.path
+            block = grids.block_of(self.coordinate)
+            if block in path[state['step']:]:
+                state['step'] = path.index(block, state['step']) + 1
+                state['since'] = self.clock()
+                if state['step'] < len(path):
+                    print 'Current Position:', self.position, 'Heading to: ', path[state['step']]
+            if state['step'] >= len(path):
+                return False
+            waypoint = path[state['step']]
+            if self.map_view(grids).block_occupancy(waypoint) or self.clock() - state['since'] > self.step_timeout:
+                return False
+            block_centre = coor2pos(grids.block_center(waypoint), grids)
+            dx = block_centre[0] - self.position[0]; dy = block_centre[1] - self.position[1]
+            angle = atan2(dy, dx)
+            error = (angle - radians(self.orientation) + pi) % (2 * pi) - pi
+            distance = sqrt(dx ** 2 + dy ** 2)
+            linear = 0.0
+            if abs(error) < pi / 4: # turn on the spot until roughly facing the block
+                if self.obstacle_ahead(degrees(angle), min(distance, self.clearance)):
+                    return False
+                linear = min(self.max_speed, distance) * cos(error)
+            self.set_speed(max(-self.max_turn, min(self.max_turn, 2 * error)), linear)
+            return True
+        self.loop.run(tick)
+        self.set_speed(0, 0)
+        return state['step'] - 1
         
     def go(self,gridsmap):
+        '''One exploration cycle, returns False when there is nothing left to explore'''
         self.scan_and_update(gridsmap)
-        self.find_target(gridsmap)
-        self.search_path(gridsmap)
-        self.follow_path(gridsmap)
+        if self.find_target(gridsmap) is None:
+            return False
+        if self.follow_path(gridsmap):
+            self.skipped = set()
+        else:
+            self.skipped.add(self.target) # blocked right away, try another frontier first
+        return True
         
         
+class unlocked():
+    '''Stands in for a lock where nothing needs locking'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+UNLOCKED = unlocked()
+
+class map_pipeline():
+    '''
+    Moves map integration off the control thread. A sensor thread fetches snapshots at rate and puts
+    them on a queue of depth scans, a worker thread integrates the ones its robot.gate lets through
+    into grids and publishes a new gridmap.view after each one. Readers take self.view, a consistent
+    version that the worker never changes, without locking. When the worker falls behind the oldest
+    queued scan is dropped. An exception on either thread stops both and is raised again by newest
+    and sync.
+    '''
+    def __init__(self, grids, client=None, rate=10.0, depth=4):
+        self.grids = grids
+        self.client = client or default_client()
+        self.period = 1.0 / rate
+        self.queue = Queue.Queue(depth)
+        self.view = grids.view() # latest published map version
+        self.mapper = robot(self.client) # pose and scan state of the worker
+        self.sleep = time.sleep
+        self.received = 0 # snapshots fetched
+        self.integrated = 0 # snapshots integrated
+        self.dropped = 0 # snapshots dropped because the queue was full
+        self.error = None # exception that stopped the sensor or worker thread
+        self._latest = None
+        self._ready = threading.Event()
+        self._done = threading.Condition() # notified after each integration
+        self._last = 0 # number of the last snapshot integrated
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        self._running = True
+        for target in (self._sense, self._integrate):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def newest(self):
+        '''Latest snapshot, waits only until the first one has arrived'''
+        self._ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self._latest
+
+    def _sense(self):
+        try:
+            while self._running:
+                t0 = time.time()
+                snap = self.client.get_snapshot()
+                self._latest = snap
+                self._ready.set()
+                self.received += 1
+                self._put((self.received, snap))
+                self.sleep(max(self.period - (time.time() - t0), 0))
+        except Exception as e:
+            self.error = e
+            self._ready.set()
+        finally:
+            self._put(None) # never blocks, the worker may be gone
+
+    def _put(self, item):
+        '''Queue item, dropping the oldest queued scan when the queue is full'''
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            try:
+                self.queue.get_nowait() # the newest scan wins
+                self.dropped += 1
+            except Queue.Empty:
+                pass
+            self.queue.put_nowait(item)
+
+    def _integrate(self):
+        try:
+            self._integrate_queue()
+        except Exception as e:
+            self.error = e
+            self._running = False
+            self._ready.set()
+        finally:
+            with self._done:
+                self._last = float('inf') # wake up sync callers
+                self._done.notify_all()
+
+    def _integrate_queue(self):
+        mapper = self.mapper
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            number, snap = item
+            mapper.snapshot = snap
+            mapper.get_position(snap)
+            mapper.get_coor(self.grids)
+            mapper.get_orientation(snap)
+            beams = mapper.gate()
+            if beams is not None:
+                with self.grids.lock:
+                    mapper.scan(self.grids)
+                    mapper.update_map(self.grids, beams or None)
+                    self.view = self.grids.view(self.view)
+                self.integrated += 1
+            with self._done:
+                self._last = number
+                self._done.notify_all()
+
+    def sync(self):
+        '''Wait until a snapshot fetched after this call is in the published view, for a robot that just stopped'''
+        wanted = self.received + 2 # the fetch in flight may predate the call
+        with self._done:
+            while self._last < wanted:
+                self._done.wait(1.0)
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        '''Stop sensing and wait until the queued scans are integrated'''
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        return {'received': self.received, 'integrated': self.integrated, 'dropped': self.dropped,
+                'queued': self.queue.qsize()}
+
+class fleet():
+    '''
+    Several robots, each with its own Lokarria client, exploring one gridmap at once on one thread
+    per robot. Scans are merged under grids.lock. Each robot claims the target it picks, and
+    find_target leaves out the claims of the others and every block within spread of them, so the
+    robots head for different parts of the map. An exception in one robot stops all of them and is
+    raised again by join.
+    '''
+    def __init__(self, grids, robots, spread=3):
+        self.grids = grids
+        self.robots = list(robots)
+        self.spread = spread
+        self.claims = {} # robot -> target block, None when it found nothing
+        self.cycles = 0
+        self.error = None # exception that stopped a robot
+        for bot in self.robots:
+            bot.fleet = self
+        self._threads = []
+        self._stopped = False
+
+    def reserved(self, bot):
+        '''Blocks bot should not target, called with grids.lock held'''
+        blocks = set()
+        for other, target in self.claims.items():
+            if other is bot or target is None:
+                continue
+            r, c = target
+            blocks.update([(r + dr, c + dc) for dr in range(-self.spread, self.spread + 1)
+                           for dc in range(-self.spread, self.spread + 1)])
+        return blocks
+
+    def start(self):
+        for bot in self.robots:
+            thread = threading.Thread(target=self._explore, args=(bot,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def _explore(self, bot):
+        try:
+            while not self._stopped:
+                if bot.go(self.grids):
+                    with self.grids.lock:
+                        self.cycles += 1
+                    continue
+                # nothing left for this robot, done once no other robot may still open up frontiers
+                with self.grids.lock:
+                    busy = [other for other in self.robots if other is not bot and self.claims.get(other, ()) is not None]
+                if not busy:
+                    return
+                bot.sleep(1.0)
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+            self._stopped = True
+        finally:
+            with self.grids.lock:
+                self.claims[bot] = None
+
+    def join(self, timeout=None):
+        '''
+        Wait until every robot is done, returns False if timeout seconds passed first.
+        Raises the exception that stopped a robot.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(deadline - time.time(), 0))
+            if thread.is_alive():
+                return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def stop(self):
+        '''Let every robot finish its current path, then stop'''
+        self._stopped = True
+
+    def running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+class tiled_layer():
+    '''
+    rows x cols map kept as square numpy tiles that are allocated the first time a cell in them is
+    written, cells of missing tiles read as default. Supports layer[r][c], layer[rows, cols] with
+    index arrays, flat indexing through ravel() and dense export through numpy.asarray.
+    '''
+    def __init__(self, rows, cols, default, dtype='uint8', tile=64):
+        self.shape = (rows, cols)
+        self.default = default
+        self.dtype = np.dtype(dtype)
+        self.tile = tile
+        self.tile_cols = (cols + tile - 1) // tile
+        self.tiles = {} # tile row * tile_cols + tile column -> tile array
+
+    @property
+    def nbytes(self):
+        return len(self.tiles) * self.tile * self.tile * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.take(key[0], key[1])
+        return tiled_row(self, key)
+
+    def __setitem__(self, key, value):
+        self.put(key[0], key[1], value)
+
+    def get(self, r, c):
+        t = self.tiles.get((r // self.tile) * self.tile_cols + c // self.tile)
+        if t is None:
+            return self.default
+        return t[r % self.tile, c % self.tile]
+
+    def set(self, r, c, value):
+        self.new_tile((r // self.tile) * self.tile_cols + c // self.tile)[r % self.tile, c % self.tile] = value
+
+    def new_tile(self, key):
+        t = self.tiles.get(key)
+        if t is None:
+            t = self.tiles[key] = np.full((self.tile, self.tile), self.default, dtype=self.dtype)
+        return t
+
+    def split(self, rows, cols):
+        '''Tile keys, unique keys with each cell's position among them, and in-tile coordinates'''
+        rows = np.asarray(rows); cols = np.asarray(cols)
+        keys = (rows // self.tile) * self.tile_cols + cols // self.tile
+        unique, inverse = np.unique(keys, return_inverse=True)
+        return unique.tolist(), inverse.reshape(keys.shape), rows % self.tile, cols % self.tile
+
+    def take(self, rows, cols):
+        rows, cols = np.broadcast_arrays(rows, cols)
+        out = np.full(rows.shape, self.default, dtype=self.dtype)
+        keys, inverse, r, c = self.split(rows, cols)
+        for i in range(len(keys)):
+            t = self.tiles.get(keys[i])
+            if t is not None:
+                mask = inverse == i
+                out[mask] = t[r[mask], c[mask]]
+        return out
+
+    def put(self, rows, cols, values):
+        rows, cols, values = np.broadcast_arrays(rows, cols, values)
+        keys, inverse, r, c = self.split(rows, cols)
+        for i in range(len(keys)):
+            mask = inverse == i
+            self.new_tile(keys[i])[r[mask], c[mask]] = values[mask]
+
+    def ravel(self):
+        return tiled_flat(self)
+
+    def copy(self):
+        layer = tiled_layer(self.shape[0], self.shape[1], self.default, self.dtype, self.tile)
+        layer.tiles = dict((key, t.copy()) for key, t in self.tiles.items())
+        return layer
+
+    def fill(self, value):
+        self.default = value
+        self.tiles = {}
+
+    def load(self, dense):
+        '''Replace the contents with a dense rows x cols array, tiles that only hold default stay unallocated'''
+        self.tiles = {}
+        for r in range(0, self.shape[0], self.tile):
+            for c in range(0, self.shape[1], self.tile):
+                part = dense[r:r + self.tile, c:c + self.tile]
+                if (part != self.default).any():
+                    self.new_tile((r // self.tile) * self.tile_cols + c // self.tile)[:part.shape[0], :part.shape[1]] = part
+
+    def __array__(self, dtype=None):
+        dense = np.full(self.shape, self.default, dtype=self.dtype)
+        for key, t in self.tiles.items():
+            r = (key // self.tile_cols) * self.tile; c = (key % self.tile_cols) * self.tile
+            dense[r:r + self.tile, c:c + self.tile] = t[:self.shape[0] - r, :self.shape[1] - c]
+        return dense if dtype is None else dense.astype(dtype)
+
+class tiled_row():
+    '''One row of a tiled_layer, so layer[r][c] reads and writes like nested lists'''
+    __slots__ = ('layer', 'row')
+    def __init__(self, layer, row):
+        self.layer = layer
+        self.row = row
+
+    def __len__(self):
+        return self.layer.shape[1]
+
+    def __getitem__(self, col):
+        return self.layer.get(self.row, col)
+
+    def __setitem__(self, col, value):
+        self.layer.set(self.row, col, value)
+
+class tiled_flat():
+    '''Flat index view of a tiled_layer, the counterpart of ndarray.ravel()'''
+    def __init__(self, layer):
+        self.layer = layer
+
+    def __getitem__(self, cells):
+        return self.layer.take(cells // self.layer.shape[1], cells % self.layer.shape[1])
+
+    def __setitem__(self, cells, values):
+        self.layer.put(cells // self.layer.shape[1], cells % self.layer.shape[1], values)
+
 class gridmap():
-    def __init__(self,a,b,c,d):
+    '''
+    Occupancy grid of resolution metre cells (default 0.5m) using HIMM values 0 - 15, grouped into
+    square blocks of block_size metres for targets and planning.
+    backend 'list' keeps nested lists, 'numpy' keeps grid and companion maps as contiguous arrays,
+    'tiled' keeps them as lazily allocated tiles so memory follows the explored area.
+    '''
+    def __init__(self,a,b,c,d,backend='list',resolution=0.5,block_size=1.0):
+        if backend not in ('list', 'numpy', 'tiled'):
+            raise ValueError('Unknown gridmap backend: %s' % backend)
+        if backend != 'list' and np is None:
+            raise ImportError('%s backend requires numpy' % backend)
+        self.backend = backend
+        self.vectorized = backend != 'list' # scans are integrated with array operations
         self.lower_left_x = a
         self.lower_left_y = b
         self.upper_right_x = c
         self.upper_right_y = d
         self.width = -a + c
         self.height = -b + d
+        self.resolution = float(resolution) # metres per cell
+        self.block_cells = max(int(round(block_size / self.resolution)), 1) # cells along a block side
+        self.block_rows = int(ceil(self.height / (self.block_cells * self.resolution) - 1e-9))
+        self.block_cols = int(ceil(self.width / (self.block_cells * self.resolution) - 1e-9))
         self.boundary = []
         # HIMM 0
         #Set 6 means the initial state is unknown
-        self.grid = [[6 for col in range((self.width) * 2)]
-                        for row in range((self.height) * 2)]
-        self.known_area = [[0 for col in range((self.width) * 2)]
-                               for row in range((self.height) * 2)]
-        #separate map into several 1mX1m blocks for setting target 
+        self.grid = self.new_layer(self.block_rows * self.block_cells, self.block_cols * self.block_cells, 6)
+        self.known_area = self.new_layer(self.block_rows * self.block_cells, self.block_cols * self.block_cells, 0)
+        #separate map into several blocks for setting target 
         #initial value 0 indicate that block the robot was never been 
-        self.blocks = [[0 for i in range(self.width / 1)] for j in range(self.height / 1)]
-        self.block_map = [[0 for i in range(self.width / 1)] for j in range(self.height / 1)]
-        self.block_idx = []
-        for row in range(len(self.blocks)):
-            for col in range(len(self.blocks[0])):
-                self.block_idx.append((row,col))
+        self.blocks = self.new_layer(self.block_rows, self.block_cols, 0)
+        self.block_map = self.new_layer(self.block_rows, self.block_cols, 0, 'int32')
+        self.planner = astar() # path planner used by search_path
+        self.renderer = None # map_renderer used by show
+        # block summaries, kept up to date by update for the blocks it touches
+        self.tick = 0 # number of scans integrated
+        self.cells_updated = 0 # cell writes of the last scan
+        self.search_expansions = 0 # blocks expanded by the last search_outward
+        self.block_occupied = self.new_summary(False, 'bool')
+        self.block_known = self.new_summary(0, 'uint16') # known cells of block_cells ** 2
+        self.block_tick = self.new_summary(0, 'int32') # last tick touched
+        self.changes = collections.deque(maxlen=256) # (tick, block rows, block cols) of recent updates
+        # frontier index: free, never visited blocks that have been seen and border a block nobody has seen
+        self.frontiers = set()
+        self.lock = threading.RLock() # held while a scan is merged or a target is picked
+        # planning pyramid, level 0 is block_occupied and every level above max-pools 2 x 2 cells of
+        # the one below, until the coarsest level is at most 8 cells wide
+        self.pyramid = [self.block_occupied]
+        rows, cols = self.block_rows, self.block_cols
+        while max(rows, cols) > 8:
+            rows = (rows + 1) // 2; cols = (cols + 1) // 2
+            self.pyramid.append(self.new_summary(False, 'bool', rows, cols))
+        # frontier blocks per coarse cell of each pyramid level above 0, kept along with frontiers
+        self.frontier_cells = [None] + [collections.Counter() for level in self.pyramid[1:]]
         '''
         #draw border
-        for i in range(self.height * 2):
+        for i in range(len(self.grid)):
             self.grid[i][0] = 15
             self.grid[i][-1] = 15
-        for i in range(self.width * 2):
+        for i in range(len(self.grid[0])):
             self.grid[0][i] = 15
             self.grid[-1][i] = 15
          '''   
                     
+    @property
+    def block_idx(self):
+        return [(row, col) for row in range(self.block_rows) for col in range(self.block_cols)]
+
+    def new_layer(self, rows, cols, value, dtype='uint8'):
+        '''Allocate a rows x cols map filled with value in the storage of this backend'''
+        if self.backend == 'numpy':
+            return np.full((rows, cols), value, dtype=dtype)
+        if self.backend == 'tiled':
+            return tiled_layer(rows, cols, value, dtype)
+        return [[value for col in range(cols)] for row in range(rows)]
+
+    def new_summary(self, value, dtype, rows=None, cols=None):
+        '''Block level map that planners read cell by cell, nested lists unless the map is tiled'''
+        rows = self.block_rows if rows is None else rows
+        cols = self.block_cols if cols is None else cols
+        if self.backend == 'tiled':
+            return tiled_layer(rows, cols, value, dtype, tile=16)
+        return [[value for col in range(cols)] for row in range(rows)]
+
+    def load_layer(self, layer, data, rows, cols):
+        '''Layer of this backend filled from rows x cols uint8 values in row major order'''
+        if self.backend == 'list':
+            data = bytearray(data.tostring() if hasattr(data, 'tostring') else data)
+            return [list(data[r * cols:(r + 1) * cols]) for r in range(rows)]
+        dense = np.asarray(data, dtype=np.uint8).reshape(rows, cols)
+        if self.backend == 'tiled':
+            layer.load(dense)
+        else:
+            layer[...] = dense
+        return layer
+
+    def export_blocks(self, rows, cols):
+        '''grid, known_area and visited values of the given blocks as bytes, cells of a block row major'''
+        k = self.block_cells
+        if self.vectorized:
+            rows = np.asarray(rows, dtype=np.intp); cols = np.asarray(cols, dtype=np.intp)
+            offset_r, offset_c = np.divmod(np.arange(k * k), k)
+            cell_r = (rows * k)[:, None] + offset_r
+            cell_c = (cols * k)[:, None] + offset_c
+            return (np.asarray(self.grid[cell_r, cell_c], dtype=np.uint8).tostring(),
+                    np.asarray(self.known_area[cell_r, cell_c], dtype=np.uint8).tostring(),
+                    np.asarray(self.blocks[rows, cols], dtype=np.uint8).tostring())
+        grid = bytearray(); known = bytearray(); visited = bytearray()
+        for row, col in zip(rows, cols):
+            for r in range(row * k, row * k + k):
+                grid.extend(self.grid[r][col * k:col * k + k])
+                known.extend(self.known_area[r][col * k:col * k + k])
+            visited.append(self.blocks[row][col])
+        return bytes(grid), bytes(known), bytes(visited)
+
+    def import_blocks(self, rows, cols, grid, known, visited):
+        '''Write back blocks exported by export_blocks, summaries are left for refresh_summaries'''
+        k = self.block_cells
+        if self.vectorized:
+            rows = np.asarray(rows, dtype=np.intp); cols = np.asarray(cols, dtype=np.intp)
+            offset_r, offset_c = np.divmod(np.arange(k * k), k)
+            cell_r = (rows * k)[:, None] + offset_r
+            cell_c = (cols * k)[:, None] + offset_c
+            shape = (len(rows), k * k)
+            self.grid[cell_r, cell_c] = np.frombuffer(grid, dtype=np.uint8).reshape(shape)
+            self.known_area[cell_r, cell_c] = np.frombuffer(known, dtype=np.uint8).reshape(shape)
+            self.blocks[rows, cols] = np.frombuffer(visited, dtype=np.uint8)
+            return
+        grid = bytearray(grid); known = bytearray(known); visited = bytearray(visited)
+        for n in range(len(rows)):
+            row = rows[n]; col = cols[n]
+            for i in range(k):
+                start = (n * k + i) * k
+                self.grid[row * k + i][col * k:col * k + k] = list(grid[start:start + k])
+                self.known_area[row * k + i][col * k:col * k + k] = list(known[start:start + k])
+            self.blocks[row][col] = visited[n]
+
+    def view(self, previous=None):
+        '''
+        Copy of the planning state (block occupancy, pyramid and frontiers) that later updates leave
+        alone, for readers on other threads. Occupancy rows untouched since previous, an earlier
+        view, are shared with it. Cell layers and the other block maps are shared, not copied.
+        '''
+        view = copy.copy(self)
+        if self.backend == 'tiled':
+            view.block_occupied = self.block_occupied.copy()
+            view.pyramid = [view.block_occupied] + [level.copy() for level in self.pyramid[1:]]
+        else:
+            if previous is None:
+                view.block_occupied = [row[:] for row in self.block_occupied]
+            else:
+                view.block_occupied = list(previous.block_occupied)
+                for row in set([block[0] for block in self.changed_blocks(previous.tick)]):
+                    view.block_occupied[row] = self.block_occupied[row][:]
+            view.pyramid = [view.block_occupied] + [[row[:] for row in level] for level in self.pyramid[1:]]
+        view.frontiers = set(self.frontiers)
+        view.frontier_cells = [None] + [collections.Counter(cells) for cells in self.frontier_cells[1:]]
+        return view
+
+    def block_of(self, coordinate):
+        '''Block holding a cell coordinate'''
+        return (coordinate[0] // self.block_cells, coordinate[1] // self.block_cells)
+
+    def nbytes(self):
+        '''Bytes held by the cell level layers (vectorized backends)'''
+        return self.grid.nbytes + self.known_area.nbytes
+
     def show(self): 
-        #for i in range(len(self.grid)):
-        #    print self.grid[i]
-        plt.imshow(self.grid)
-        plt.savefig('MAP.jpg')
+        '''Hand the map to the background renderer, nothing to do when none is attached'''
+        if self.renderer is not None:
+            self.renderer.submit(self.grid)
         
     def reset_scan_area(self):
-        self.known_area = [[1 for col in range((self.width) * 2)]
-                               for row in range((self.height) * 2)] 
+        self.known_area = self.new_layer(len(self.grid), len(self.grid[0]), 1)
         
     def update(self,area):
+        '''
+        Integrate one scan. area holds the beam end points followed by the robot coordinate.
+        '''
         self.boundary = area
+        self.tick += 1
+        b0 = self.block_of(area[-1])
+        self.blocks[b0[0]][b0[1]] = 1 #update block status, current block has been explored
+        if self.vectorized:
+            rows, cols = self.update_batch(area)
+        else:
+            touched = self.update_rays(area)
+            touched.add(b0)
+            rows = [block[0] for block in touched]
+            cols = [block[1] for block in touched]
+        self.changes.append((self.tick,) + self.refresh_summaries(rows, cols))
+        self.refresh_frontiers([b0[0]], [b0[1]]) # the robot block is visited now
+
+    def update_rays(self, area):
+        '''HIMM update beam by beam (list backend), returns the set of blocks touched'''
         r0 = area[-1][0]; c0 = area[-1][1]
-        self.blocks[r0 // 2][c0 // 2] = 1 #update block status, current block has been explored
-        for i in range(271):
+        k = self.block_cells
+        touched = set()
+        r_max = len(self.grid) - 1
+        c_max = len(self.grid[0]) - 1
+        updated = len(area) - 1
+        for i in range(len(area) - 1):
             r1 = area[i][0]; c1 = area[i][1]
+            touched.add((r1 // k, c1 // k))
             self.known_area[r1][c1] = 1
             if self.grid[r1][c1] <= 12: # HIMM 
                 self.grid[r1][c1] += 3
@@ -394,9 +1435,13 @@ class gridmap():
                     step_c = -1
                 step_r = float(delta_r) / abs(delta_c)
                 for j in range(abs(delta_c)):
-                    if self.grid[min(r0 + int(round(j * step_r)), self.height * 2 - 1)][min(c0 + j * step_c, self.height * 2 - 1)] > 0:
-                        self.grid[min(r0 + int(round(j * step_r)), self.height * 2 - 1)][min(c0 + j * step_c, self.height * 2 -1)] -= 1 # HIMM 1
-                        self.known_area[min(r0 + int(round(j * step_r)), self.height * 2 - 1)][min(c0 + j * step_c, self.height * 2 -1)] = 1
+                    r = min(r0 + int(round(j * step_r)), r_max)
+                    c = min(c0 + j * step_c, c_max)
+                    if self.grid[r][c] > 0:
+                        self.grid[r][c] -= 1 # HIMM 1
+                        self.known_area[r][c] = 1
+                        touched.add((r // k, c // k))
+                        updated += 1
             elif abs(delta_c) < abs(delta_r):
                 step_c = float(delta_c) / abs(delta_r)
                 if delta_r > 0:
@@ -404,9 +1449,288 @@ class gridmap():
                 else:
                     step_r = -1
                 for j in range(abs(delta_r)):
-                    if self.grid[min(r0 + j * step_r, self.width * 2 - 1)][min(c0 + int(round(j * step_c)), self.width * 2 - 1)] > 0:
-                        self.grid[min(r0 + j * step_r, self.width * 2 - 1)][min(c0 + int(round(j * step_c)), self.width * 2 - 1)] -= 1 # HIMM 1
-                        self.known_area[min(r0 + j * step_r, self.width * 2 - 1)][min(c0 + int(round(j * step_c)), self.width * 2 - 1)] = 1
+                    r = min(r0 + j * step_r, r_max)
+                    c = min(c0 + int(round(j * step_c)), c_max)
+                    if self.grid[r][c] > 0:
+                        self.grid[r][c] -= 1 # HIMM 1
+                        self.known_area[r][c] = 1
+                        touched.add((r // k, c // k))
+                        updated += 1
+        self.cells_updated = updated
+        return touched
+
+    def update_batch(self, area):
+        '''
+        HIMM update of a whole scan as bulk array operations (vectorized backends).
+        Every cell crossed by a beam loses 1 per crossing beam, then every end point gains 3 per hit,
+        only cells at 12 or below are raised and the value is capped at 15. As in update_rays a crossed
+        cell becomes known only if it was above 0.
+        The result is close to update_rays but not identical: beams are traced with trace_rays, which
+        rounds half to even and draws axis-parallel beams straight where update_rays shifts them by
+        half a cell, and all decrements land before the end point raises instead of beam by beam.
+        A few cells along beam edges therefore differ between the list and the vectorized backends.
+        Returns the rows and columns of the blocks touched.
+        '''
+        area = np.asarray(area, dtype=np.intp)
+        rows, cols = self.grid.shape
+        grid = self.grid.ravel()
+        known = self.known_area.ravel()
+        free = trace_rays(area[-1], area[:-1], self.grid.shape)
+        cells, hits = np.unique(free, return_counts=True)
+        values = grid[cells]
+        known[cells[values > 0]] = 1
+        grid[cells] = np.maximum(values.astype(np.int16) - hits, 0) # HIMM 1
+        ends = np.clip(area[:-1, 0], 0, rows - 1) * cols + np.clip(area[:-1, 1], 0, cols - 1)
+        ends, hits = np.unique(ends, return_counts=True)
+        values = grid[ends]
+        grid[ends] = np.where(values <= 12, np.minimum(values + 3 * hits, 15), values) # HIMM
+        known[ends] = 1
+        self.cells_updated = len(cells) + len(ends)
+        cells = np.concatenate((cells, ends, [area[-1, 0] * cols + area[-1, 1]]))
+        k = self.block_cells
+        blocks = np.unique((cells // cols // k) * self.block_cols + (cells % cols) // k)
+        return blocks // self.block_cols, blocks % self.block_cols
+
+    def refresh_summaries(self, rows=None, cols=None):
+        '''
+        Recompute the summaries of the blocks at rows, cols from their cells, all blocks if None.
+        Call it after writing to grid or known_area directly. Returns the blocks as row and column lists.
+        '''
+        k = self.block_cells
+        full = rows is None
+        if full and self.vectorized:
+            rows, cols = np.divmod(np.arange(self.block_rows * self.block_cols), self.block_cols)
+        elif full:
+            rows = [row for row in range(self.block_rows) for col in range(self.block_cols)]
+            cols = [col for row in range(self.block_rows) for col in range(self.block_cols)]
+        if self.vectorized:
+            rows = np.asarray(rows); cols = np.asarray(cols)
+            offset_r, offset_c = np.divmod(np.arange(k * k), k)
+            cell_r = (rows * k)[:, None] + offset_r
+            cell_c = (cols * k)[:, None] + offset_c
+            occupied = self.grid[cell_r, cell_c].max(axis=1) >= 12
+            known = self.known_area[cell_r, cell_c].sum(axis=1)
+            if self.backend == 'tiled':
+                # tiled summaries take whole index arrays at once
+                changed = (self.block_occupied[rows, cols] != occupied) | (self.block_known[rows, cols] != known)
+                self.block_occupied[rows, cols] = occupied
+                self.block_known[rows, cols] = known
+                self.block_tick[rows, cols] = self.tick
+                if full:
+                    self.rebuild_indexes()
+                else:
+                    self.refresh_frontiers(rows[changed].tolist(), cols[changed].tolist())
+                    self.refresh_pyramid(rows[changed].tolist(), cols[changed].tolist())
+                return rows.tolist(), cols.tolist()
+            if full:
+                # rows and cols run over the whole map in order, write the summaries row by row
+                occupied = occupied.reshape(self.block_rows, self.block_cols).tolist()
+                known = known.reshape(self.block_rows, self.block_cols).tolist()
+                for row in range(self.block_rows):
+                    self.block_occupied[row][:] = occupied[row]
+                    self.block_known[row][:] = known[row]
+                    self.block_tick[row][:] = [self.tick] * self.block_cols
+                self.rebuild_indexes()
+                return rows.tolist(), cols.tolist()
+            occupied = occupied.tolist(); known = known.tolist()
+            rows = rows.tolist(); cols = cols.tolist()
+        else:
+            occupied = []; known = []
+            for row, col in zip(rows, cols):
+                cells = [(row * k + i, col * k + j) for i in range(k) for j in range(k)]
+                occupied.append(max([self.grid[r][c] for r, c in cells]) >= 12)
+                known.append(sum([self.known_area[r][c] for r, c in cells]))
+        changed_r = []; changed_c = []
+        for i in range(len(rows)):
+            row = rows[i]; col = cols[i]
+            if self.block_occupied[row][col] != occupied[i] or self.block_known[row][col] != known[i]:
+                changed_r.append(row); changed_c.append(col)
+            self.block_occupied[row][col] = occupied[i]
+            self.block_known[row][col] = known[i]
+            self.block_tick[row][col] = self.tick
+        if full:
+            self.rebuild_indexes()
+        else:
+            self.refresh_frontiers(changed_r, changed_c)
+            self.refresh_pyramid(changed_r, changed_c)
+        return rows, cols
+
+    def rebuild_indexes(self):
+        '''Recompute the frontier set and the pyramid from the block summaries of the whole map'''
+        if np is None:
+            rows = [row for row in range(self.block_rows) for col in range(self.block_cols)]
+            cols = [col for row in range(self.block_rows) for col in range(self.block_cols)]
+            self.frontiers = set()
+            self.frontier_cells = [None] + [collections.Counter() for level in self.pyramid[1:]]
+            self.refresh_frontiers(rows, cols)
+            self.refresh_pyramid(rows, cols)
+            return
+        occupied = np.asarray(self.block_occupied, dtype=bool)
+        known = np.asarray(self.block_known) > 0
+        unknown = np.pad(~known, 1, 'constant') # outside the map does not count as unknown
+        border = unknown[:-2, 1:-1] | unknown[2:, 1:-1] | unknown[1:-1, :-2] | unknown[1:-1, 2:]
+        rows, cols = np.nonzero(~occupied & known & (np.asarray(self.blocks) == 0) & border)
+        self.frontiers = set(zip(rows.tolist(), cols.tolist()))
+        for n in range(1, len(self.pyramid)):
+            self.frontier_cells[n] = collections.Counter(zip((rows >> n).tolist(), (cols >> n).tolist()))
+        level = occupied
+        for n in range(1, len(self.pyramid)):
+            rows = (level.shape[0] + 1) // 2; cols = (level.shape[1] + 1) // 2
+            padded = np.zeros((rows * 2, cols * 2), dtype=bool)
+            padded[:level.shape[0], :level.shape[1]] = level
+            level = padded.reshape(rows, 2, cols, 2).any(axis=3).any(axis=1)
+            if self.backend == 'tiled':
+                self.pyramid[n].load(level)
+            else:
+                self.pyramid[n] = level.tolist()
+
+    def is_frontier(self, row, col):
+        if self.block_occupied[row][col] or not self.block_known[row][col] or self.blocks[row][col]:
+            return False
+        for r, c in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)):
+            if 0 <= r < self.block_rows and 0 <= c < self.block_cols and self.block_known[r][c] == 0:
+                return True
+        return False
+
+    def refresh_frontiers(self, rows, cols):
+        '''Re-check the frontier status of the given blocks and their neighbours'''
+        candidates = set()
+        for row, col in zip(rows, cols):
+            candidates.update(((row, col), (row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)))
+        for block in candidates:
+            row, col = block
+            found = 0 <= row < self.block_rows and 0 <= col < self.block_cols and self.is_frontier(row, col)
+            if found == (block in self.frontiers):
+                continue
+            if found:
+                self.frontiers.add(block)
+            else:
+                self.frontiers.remove(block)
+            for level in range(1, len(self.pyramid)):
+                cell = (row >> level, col >> level)
+                self.frontier_cells[level][cell] += 1 if found else -1
+                if not self.frontier_cells[level][cell]:
+                    del self.frontier_cells[level][cell]
+
+    def frontiers_in(self, cell, level, exclude=()):
+        '''Frontier blocks outside exclude inside a coarse cell of a pyramid level above 0'''
+        if cell not in self.frontier_cells[level]:
+            return []
+        size = 1 << level
+        return [(row, col) for row in range(cell[0] * size, min((cell[0] + 1) * size, self.block_rows))
+                for col in range(cell[1] * size, min((cell[1] + 1) * size, self.block_cols))
+                if (row, col) in self.frontiers and (row, col) not in exclude]
+
+    def refresh_pyramid(self, rows, cols):
+        '''Max-pool the blocks at rows, cols up through the coarser pyramid levels, stops once nothing changes'''
+        cells = set(zip(rows, cols))
+        for level in range(1, len(self.pyramid)):
+            below = self.pyramid[level - 1]
+            layer = self.pyramid[level]
+            n_rows = len(below); n_cols = len(below[0])
+            changed = set()
+            for r, c in set([(row // 2, col // 2) for row, col in cells]):
+                value = False
+                for i in (2 * r, 2 * r + 1):
+                    for j in (2 * c, 2 * c + 1):
+                        if i < n_rows and j < n_cols and below[i][j]:
+                            value = True
+                if layer[r][c] != value:
+                    layer[r][c] = value
+                    changed.add((r, c))
+            if not changed:
+                break
+            cells = changed
+
+    def nearest_frontier(self, start_block, exclude=(), diagonal=False, level=0):
+        '''
+        Search outward from start_block over free blocks for the frontier with the lowest path cost.
+        With level > 0 the search runs on that pyramid level to find the nearest coarse cell holding a
+        frontier, and the closest frontier in it is planned to with coarse_to_fine.
+        Returns (target, path), (None, []) when no frontier outside exclude can be reached.
+        '''
+        start_block = tuple(start_block)
+        if not self.frontiers:
+            return None, []
+        level = min(level, len(self.pyramid) - 1)
+        if level > 0:
+            skip = set(exclude) | set([start_block])
+            start = (start_block[0] >> level, start_block[1] >> level)
+            # coarse cells holding a wall are only expensive, a door may hide in them
+            cell = self.search_outward(self.pyramid[level], start, lambda cell: self.frontiers_in(cell, level, skip),
+                                       diagonal, blocked_cost=4)[0]
+            if cell is None:
+                return None, []
+            targets = sorted(self.frontiers_in(cell, level, skip),
+                             key=lambda b: (b[0] - start_block[0]) ** 2 + (b[1] - start_block[1]) ** 2)
+            path = coarse_to_fine(level, diagonal).plan(self, start_block, targets[0])
+            if path:
+                return targets[0], path
+        is_target = lambda block: block in self.frontiers and block != start_block and block not in exclude
+        return self.search_outward(self.block_occupied, start_block, is_target, diagonal)
+
+    def search_outward(self, occupied, start, is_target, diagonal=False, blocked_cost=None):
+        '''
+        Dijkstra search from start over an occupancy level until is_target accepts a cell.
+        Occupied cells are walls, or cost blocked_cost per step when it is given.
+        Returns (target, path), (None, []) when no target can be reached.
+        '''
+        rows = len(occupied); cols = len(occupied[0])
+        moves = [(-1, 0, 1), (1, 0, 1), (0, -1, 1), (0, 1, 1)]
+        if diagonal:
+            moves += [(-1, -1, sqrt(2)), (-1, 1, sqrt(2)), (1, -1, sqrt(2)), (1, 1, sqrt(2))]
+        cost = {start: 0}
+        parent = {start: None}
+        frontier = [(0, start)]
+        expansions = 0
+        while frontier:
+            g, block = heapq.heappop(frontier)
+            if g > cost[block]:
+                continue
+            expansions += 1
+            if is_target(block):
+                self.search_expansions = expansions
+                path = []
+                target = block
+                while block is not None:
+                    path.append(block)
+                    block = parent[block]
+                path.reverse()
+                return target, path
+            r, c = block
+            for dr, dc, step in moves:
+                nr = r + dr; nc = c + dc
+                if nr < 0 or nr >= rows or nc < 0 or nc >= cols:
+                    continue
+                if occupied[nr][nc]:
+                    if blocked_cost is None:
+                        continue
+                    step *= blocked_cost
+                elif dr and dc and blocked_cost is None and (occupied[r][nc] or occupied[nr][c]):
+                    continue
+                move = (nr, nc)
+                if g + step < cost.get(move, float('inf')):
+                    cost[move] = g + step
+                    parent[move] = block
+                    heapq.heappush(frontier, (g + step, move))
+        self.search_expansions = expansions
+        return None, []
+
+    def known_fraction(self, block_coord):
+        return self.block_known[block_coord[0]][block_coord[1]] / float(self.block_cells ** 2)
+
+    def changed_blocks(self, since):
+        '''Blocks touched by updates after the given tick'''
+        if since >= self.tick:
+            return set()
+        if self.changes and self.changes[0][0] <= since + 1:
+            result = set()
+            for tick, rows, cols in reversed(self.changes):
+                if tick <= since:
+                    break
+                result.update(zip(rows, cols))
+            return result
+        return set(b for b in self.block_idx if self.block_tick[b[0]][b[1]] > since)
             
     def check_unkown(self,block_coord):
         if self.blocks[block_coord[0]][block_coord[1]] == 0:
@@ -415,122 +1739,785 @@ class gridmap():
             return False
         
     def block_center(self,block_coord):
-        return (block_coord[0] * 2 + 2 , block_coord[1] * 2 + 2)
+        '''Cell coordinate of the block centre, fractional for coor2pos'''
+        half = self.block_cells / 2.0
+        return (block_coord[0] * self.block_cells + half, block_coord[1] * self.block_cells + half)
     
     def block_occupancy(self,block_coord):
-        row_s = block_coord[0] * 2
-        row_e = row_s + 2
-        col_s = block_coord[1] * 2
-        col_e = col_s + 2
-        for r in range(row_s, row_e):
-            for c in range(col_s, col_e):
-                if self.grid[r][c] >= 12:
-                    return True       
-        return False    
+        return self.block_occupied[block_coord[0]][block_coord[1]]
     
     def reset_blockmap(self):
-        self.block_map = [[0 for i in range(self.width / 1)] for j in range(self.height / 1)]
+        if self.vectorized:
+            self.block_map.fill(0)
+        else:
+            self.block_map = self.new_layer(self.block_rows, self.block_cols, 0)
     
-    def search_path(self,start_block,target_block):
+    def occupancy(self):
+        '''Boolean block map, True where a block holds an occupied cell. Planners read it directly.'''
+        return self.block_occupied
+
+    def search_path(self,start_block,target_block,planner=None):
         '''
-        use wavefront algorithm to find a path 
+        Find a block path from start to target with the given planner (default self.planner).
+        Returns an empty list when the target cannot be reached.
         '''
-        self.reset_blockmap()
-        print 'Start block:',start_block,' Target Block:',target_block
+        return (planner or self.planner).plan(self, tuple(start_block), tuple(target_block))
+
+class wavefront():
+    '''
+    Wavefront planner, floods the block map from the target until the start is reached.
+    '''
+    def __init__(self):
+        self.expansions = 0 # blocks expanded by the last plan
+
+    def plan(self, grids, start_block, target_block):
+        occupied = grids.occupancy()
+        grids.reset_blockmap()
+        block_map = grids.block_map
+        rows = len(block_map); cols = len(block_map[0])
+        self.expansions = 0
         #wavefront : update map value to navigate
-        waves = [target_block]
+        waves = set([target_block])
         n = 2
-        self.block_map[target_block[0]][target_block[1]] = 2
+        block_map[target_block[0]][target_block[1]] = 2
         while start_block not in waves:
+            if not waves:
+                return [] # start is not reachable
             n += 1
             temp_wave = set()
             for block in waves:
-                #print block
+                self.expansions += 1
                 block_w = (block[0], max(block[1] - 1 , 0))              
-                block_e = (block[0], min(block[1] + 1, len(self.block_map[0]) - 1))
+                block_e = (block[0], min(block[1] + 1, cols - 1))
                 block_n = (max(block[0] - 1 , 0), block[1])
-                block_s = (min(block[0] + 1,len(self.block_map) - 1), block[1])
-                if start_block in [block_e,block_n,block_s,block_w]:
-                    temp_wave.add(start_block)
-                if not self.block_occupancy(block_w):
-                    if self.block_map[block_w[0]][block_w[1]] == 0:
-                        temp_wave.add(block_w)
-                if not self.block_occupancy(block_e):
-                    if self.block_map[block_e[0]][block_e[1]] == 0:
-                        temp_wave.add(block_e)
-                if not self.block_occupancy(block_n):
-                    if self.block_map[block_n[0]][block_n[1]] == 0:
-                        temp_wave.add(block_n)
-                if not self.block_occupancy(block_s):
-                    if self.block_map[block_s[0]][block_s[1]] == 0:
-                        temp_wave.add(block_s)
+                block_s = (min(block[0] + 1, rows - 1), block[1])
+                for move in (block_w, block_e, block_n, block_s):
+                    if move == start_block:
+                        temp_wave.add(start_block)
+                    elif not occupied[move[0]][move[1]] and block_map[move[0]][move[1]] == 0:
+                        temp_wave.add(move)
             for move in temp_wave:
-                self.block_map[move[0]][move[1]] = n
-            waves = list(temp_wave) 
-            #for i in range(len(self.block_map)):
-            #    print i,self.block_map[i]
-            #print ''      
+                block_map[move[0]][move[1]] = n
+            waves = temp_wave
         #find one way
         path = []
-        value = self.block_map[start_block[0]][start_block[1]]
+        value = block_map[start_block[0]][start_block[1]]
         path.append(start_block)
-        while target_block not in path:
+        while path[-1] != target_block:
             value -= 1
             move = path[-1]
             move_n = (max(move[0] - 1 , 0), move[1])
-            move_s = (min(move[0] + 1,len(self.block_map) - 1), move[1])
-            move_e = (move[0], min(move[1] + 1, len(self.block_map[0]) - 1))
+            move_s = (min(move[0] + 1, rows - 1), move[1])
+            move_e = (move[0], min(move[1] + 1, cols - 1))
             move_w = (move[0], max(move[1] - 1 , 0))
-            if self.block_map[move_n[0]][move_n[1]] == value:
+            if block_map[move_n[0]][move_n[1]] == value:
                 path.append(move_n)
-            elif self.block_map[move_e[0]][move_e[1]] == value:
+            elif block_map[move_e[0]][move_e[1]] == value:
                 path.append(move_e)
-            elif self.block_map[move_s[0]][move_s[1]] == value:
+            elif block_map[move_s[0]][move_s[1]] == value:
                 path.append(move_s)
-            elif self.block_map[move_w[0]][move_w[1]] == value:
+            elif block_map[move_w[0]][move_w[1]] == value:
                 path.append(move_w)
-        print path 
-              
+        return path
+
+class astar():
+    '''
+    A* planner over the cached block occupancy grid.
+    With diagonal=True moves go 8-connected, a diagonal is only taken when both side blocks are free.
+    The start block is always accepted, the robot may sit next to a wall.
+    '''
+    def __init__(self, diagonal=False):
+        self.diagonal = diagonal
+        self.expansions = 0 # blocks expanded by the last plan
+
+    def heuristic(self, a, b):
+        dr = abs(a[0] - b[0]); dc = abs(a[1] - b[1])
+        if self.diagonal:
+            return max(dr, dc) + (sqrt(2) - 1) * min(dr, dc)
+        return dr + dc
+
+    def plan(self, grids, start_block, target_block):
+        self.expansions = 0
+        return self.search(grids.occupancy(), start_block, target_block)
+
+    def search(self, occupied, start_block, target_block, corridor=None, shift=0, blocked_cost=None):
+        '''
+        A* over one occupancy level. corridor optionally limits the search to blocks whose
+        (row >> shift, col >> shift) cell is in it. With blocked_cost occupied cells are
+        passable at that cost per step instead of walls.
+        '''
+        rows = len(occupied); cols = len(occupied[0])
+        if blocked_cost is None and occupied[target_block[0]][target_block[1]]:
+            return []
+        moves = [(-1, 0, 1), (1, 0, 1), (0, -1, 1), (0, 1, 1)]
+        if self.diagonal:
+            moves += [(-1, -1, sqrt(2)), (-1, 1, sqrt(2)), (1, -1, sqrt(2)), (1, 1, sqrt(2))]
+        cost = {start_block: 0}
+        parent = {start_block: None}
+        frontier = [(self.heuristic(start_block, target_block), 0, start_block)]
+        closed = set()
+        while frontier:
+            f, g, block = heapq.heappop(frontier)
+            if block in closed:
+                continue
+            if block == target_block:
+                path = []
+                while block is not None:
+                    path.append(block)
+                    block = parent[block]
+                path.reverse()
+                return path
+            closed.add(block)
+            self.expansions += 1
+            r, c = block
+            for dr, dc, step in moves:
+                nr = r + dr; nc = c + dc
+                if nr < 0 or nr >= rows or nc < 0 or nc >= cols:
+                    continue
+                if corridor is not None and (nr >> shift, nc >> shift) not in corridor:
+                    continue
+                if occupied[nr][nc]:
+                    if blocked_cost is None:
+                        continue
+                    step *= blocked_cost
+                elif dr and dc and blocked_cost is None and (occupied[r][nc] or occupied[nr][c]):
+                    continue # do not cut corners
+                move = (nr, nc)
+                g_move = g + step
+                if g_move < cost.get(move, float('inf')):
+                    cost[move] = g_move
+                    parent[move] = block
+                    heapq.heappush(frontier, (g_move + self.heuristic(move, target_block), g_move, move))
+        return []
+
+class coarse_to_fine():
+    '''
+    Hierarchical planner over the gridmap pyramid. A* first runs on a coarse level, where a cell
+    covers 2 ** level blocks a side and cells holding a wall are passable at a high cost, then
+    the block path is searched only in the corridor of coarse cells along that path and their
+    neighbours. Falls back to a search over the whole block map when the corridor is closed.
+    '''
+    def __init__(self, level=2, diagonal=False):
+        self.level = level
+        self.coarse = astar(diagonal)
+        self.fine = astar(diagonal)
+        self.expansions = 0 # cells expanded on all levels by the last plan
+
+    def plan(self, grids, start_block, target_block):
+        level = min(self.level, len(grids.pyramid) - 1)
+        self.expansions = 0
+        self.coarse.expansions = self.fine.expansions = 0
+        path = []
+        if level > 0:
+            start = (start_block[0] >> level, start_block[1] >> level)
+            target = (target_block[0] >> level, target_block[1] >> level)
+            coarse_path = self.coarse.search(grids.pyramid[level], start, target, blocked_cost=4)
+            corridor = set()
+            for r, c in coarse_path:
+                corridor.update([(r + dr, c + dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1)])
+            path = self.fine.search(grids.occupancy(), start_block, target_block, corridor, level)
+        if not path:
+            path = self.fine.search(grids.occupancy(), start_block, target_block)
+        self.expansions = self.coarse.expansions + self.fine.expansions
         return path
     
-if __name__ == '__main__':
-    global MRDS_URL
-    
-    input_para = []
-    for i in range(len(sys.argv)-1):
-        input_para.append(sys.argv[i+1])
+def replace_file(src, dst):
+    '''Move src over dst, atomic on POSIX. Windows cannot rename over an existing file.'''
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
 
-    print input_para
-    MRDS_URL = input_para[0]
-    if 'http://' in MRDS_URL:
-        MRDS_URL.replace('http://','')
-    a = int(input_para[1])
-    b = int(input_para[2])
-    c = int(input_para[3])
-    d = int(input_para[4])
+def write_png(path, grid):
+    '''Write a HIMM grid as an 8 bit grayscale PNG, occupied cells dark, without any imaging library'''
+    if np is not None:
+        pixels = (255 - np.asarray(grid, dtype=np.uint8) * 17).astype(np.uint8)
+        rows, cols = pixels.shape
+        raw = b''.join([b'\x00' + pixels[r].tostring() for r in range(rows)])
+    else:
+        rows = len(grid); cols = len(grid[0])
+        raw = b''.join([b'\x00' + bytes(bytearray([255 - v * 17 for v in row])) for row in grid])
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', cols, rows, 8, 0, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw, 1)))
+        f.write(chunk(b'IEND', b''))
+
+def write_npy(path, grid):
+    '''Dump a grid sized layer as a uint8 .npy array that numpy.load reads, without numpy'''
+    header = "{'descr': '|u1', 'fortran_order': False, 'shape': (%d, %d), }" % (len(grid), len(grid[0]))
+    header += ' ' * (-(len(header) + 11) % 64) + '\n' # the data starts 64 byte aligned
+    with open(path, 'wb') as f:
+        f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin-1'))
+        f.write(layer_bytes(grid))
+
+MAP_OUTPUTS = ['png', 'npy', 'matplotlib'] # map_renderer modes
+
+class map_renderer():
+    '''
+    Writes map images on a background thread so mapping and driving never wait on image encoding.
+    submit() copies the grid and returns at once. A frame is dropped if the previous one is still
+    being written or came less than 1/fps seconds ago. Files are written beside path and renamed over it.
+    mode 'png' writes the raw grid with write_png, 'npy' dumps it with write_npy, 'matplotlib' redraws
+    one reused figure and is the only mode that imports matplotlib.
+    A frame that fails to render is counted in errors and the thread goes on with the next one,
+    close() raises the failure if no frame was written after it.
+    '''
+    def __init__(self, path='MAP.png', fps=1.0, mode='png'):
+        self.path = path
+        self.interval = 1.0 / fps
+        self.mode = mode
+        self.frames = 0 # frames written
+        self.dropped = 0 # frames dropped because the renderer was busy or rate limited
+        self.errors = 0 # frames that failed to render
+        self.error = None # exception of the last frame if it failed
+        self.figure = None
+        self._frame = None
+        self._busy = False
+        self._last = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, grid):
+        '''Queue a copy of grid for rendering, returns False if the frame was dropped'''
+        now = time.time()
+        with self._lock:
+            if self._busy or now - self._last < self.interval:
+                self.dropped += 1
+                return False
+            self._busy = True
+            self._last = now
+        if np is not None:
+            self._frame = np.array(grid, dtype=np.uint8)
+        else:
+            self._frame = [list(row) for row in grid]
+        self._wake.set()
+        return True
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if not self._running:
+                return
+            try:
+                self.render(self._frame)
+            except Exception as e:
+                self.errors += 1
+                self.error = e
+            finally:
+                with self._lock:
+                    self._busy = False
+
+    def render(self, grid):
+        tmp = self.path + '.tmp'
+        if self.mode == 'matplotlib':
+            if self.figure is None:
+                from matplotlib.figure import Figure
+                from matplotlib.backends.backend_agg import FigureCanvasAgg
+                self.figure = Figure()
+                FigureCanvasAgg(self.figure)
+                self.image = self.figure.add_subplot(111).imshow(grid, vmin=0, vmax=15)
+            else:
+                self.image.set_data(grid)
+            self.figure.savefig(tmp, format=os.path.splitext(self.path)[1][1:] or 'png')
+        elif self.mode == 'npy':
+            write_npy(tmp, grid)
+        else:
+            write_png(tmp, grid)
+        replace_file(tmp, self.path)
+        self.frames += 1
+        self.error = None
+
+    def close(self, grid=None):
+        '''Stop the thread, then render grid (the final map) if given. Raises the error of a failed last frame.'''
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+        if grid is not None:
+            self.render(grid)
+        if self.error is not None:
+            raise self.error
+
+CHECKPOINT_MAGIC = b'MCKP\x01'
+CHECKPOINT_HEADER = struct.Struct('<5s5dIIIIIQ') # magic, corners, resolution, block cells, grid rows and columns, block rows and columns, tick
+CHECKPOINT_OFFSET = 128 # layers start here, the header is padded so they can be memory mapped
+DELTA_MAGIC = b'MDLT'
+DELTA_HEADER = struct.Struct('<4sQI') # magic, tick, number of blocks
+
+def layer_bytes(layer):
+    '''A grid sized layer as row major uint8 bytes'''
+    if np is not None and not isinstance(layer, list):
+        return np.ascontiguousarray(np.asarray(layer), dtype=np.uint8).tostring()
+    return bytes(bytearray([v for row in layer for v in row]))
+
+def save_checkpoint(grids, path):
+    '''
+    Write grid, known_area and blocks of a map as uint8 layers after a fixed size header with bounds,
+    resolution and tick. Written beside path and renamed over it.
+    '''
+    rows = len(grids.grid); cols = len(grids.grid[0])
+    header = CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, grids.lower_left_x, grids.lower_left_y, grids.upper_right_x,
+                                    grids.upper_right_y, grids.resolution, grids.block_cells, rows, cols,
+                                    grids.block_rows, grids.block_cols, grids.tick)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header.ljust(CHECKPOINT_OFFSET, b'\x00'))
+        f.write(layer_bytes(grids.grid))
+        f.write(layer_bytes(grids.known_area))
+        f.write(layer_bytes(grids.blocks))
+    replace_file(tmp, path)
+
+def append_delta(grids, path, since):
+    '''Append the cells of every block touched after tick since to the delta file at path'''
+    blocks = sorted(grids.changed_blocks(since))
+    rows = [block[0] for block in blocks]
+    cols = [block[1] for block in blocks]
+    grid, known, visited = grids.export_blocks(rows, cols)
+    index = struct.pack('<%dI' % len(blocks), *[row * grids.block_cols + col for row, col in blocks])
+    with open(path, 'ab') as f:
+        f.write(DELTA_HEADER.pack(DELTA_MAGIC, grids.tick, len(blocks)) + index + grid + known + visited)
+
+def load_checkpoint(path, backend='numpy'):
+    '''
+    Rebuild a gridmap from a checkpoint and the delta records in path + '.delta' written after it.
+    With numpy the layers are read through a memory map. Block summaries and frontiers are recomputed.
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(CHECKPOINT_OFFSET)
+        if not header.startswith(CHECKPOINT_MAGIC):
+            raise ValueError('%s is not a map checkpoint' % path)
+        fields = CHECKPOINT_HEADER.unpack_from(header)
+        corners = [int(v) if v == int(v) else v for v in fields[1:5]]
+        resolution, block_cells, rows, cols, block_rows, block_cols, tick = fields[5:]
+        grids = gridmap(*(corners + [backend, resolution, block_cells * resolution]))
+        if (len(grids.grid), len(grids.grid[0]), grids.block_rows, grids.block_cols) != (rows, cols, block_rows, block_cols):
+            raise ValueError('%s does not match the map layout of this version' % path)
+        sizes = [rows * cols, rows * cols, block_rows * block_cols]
+        if np is not None:
+            data = np.memmap(path, dtype=np.uint8, mode='r', offset=CHECKPOINT_OFFSET, shape=(sum(sizes),))
+        else:
+            data = bytearray(f.read(sum(sizes)))
+    grids.grid = grids.load_layer(grids.grid, data[:sizes[0]], rows, cols)
+    grids.known_area = grids.load_layer(grids.known_area, data[sizes[0]:sizes[0] + sizes[1]], rows, cols)
+    grids.blocks = grids.load_layer(grids.blocks, data[sizes[0] + sizes[1]:], block_rows, block_cols)
+    grids.tick = tick
+    if os.path.exists(path + '.delta'):
+        with open(path + '.delta', 'rb') as f:
+            deltas = f.read()
+        k2 = block_cells ** 2
+        i = 0
+        while i + DELTA_HEADER.size <= len(deltas):
+            magic, delta_tick, count = DELTA_HEADER.unpack_from(deltas, i)
+            size = DELTA_HEADER.size + count * (4 + 2 * k2 + 1)
+            if magic != DELTA_MAGIC or i + size > len(deltas):
+                break # truncated by a crash
+            if delta_tick > grids.tick: # records older than the checkpoint were already folded in
+                j = i + DELTA_HEADER.size
+                index = struct.unpack_from('<%dI' % count, deltas, j)
+                j += 4 * count
+                grids.import_blocks([b // block_cols for b in index], [b % block_cols for b in index],
+                                    deltas[j:j + count * k2], deltas[j + count * k2:j + 2 * count * k2],
+                                    deltas[j + 2 * count * k2:j + 2 * count * k2 + count])
+                grids.tick = delta_tick
+            i += size
+    grids.refresh_summaries()
+    return grids
+
+class checkpointer():
+    '''
+    Periodic map checkpoints for resuming after a crash. save() writes a full checkpoint every
+    full_every saves and in between appends the blocks touched since the previous save to
+    path + '.delta'. maybe() saves once interval seconds have passed.
+    '''
+    def __init__(self, grids, path='MAP.ckpt', interval=30.0, full_every=10):
+        self.grids = grids
+        self.path = path
+        self.interval = interval
+        self.full_every = full_every
+        self.saves = 0
+        self.tick = grids.tick # tick of the last save
+        self._last = time.time()
+
+    def maybe(self):
+        if time.time() - self._last >= self.interval:
+            self.save()
+
+    def save(self, full=False):
+        with self.grids.lock:
+            if full or self.saves % self.full_every == 0:
+                save_checkpoint(self.grids, self.path)
+                open(self.path + '.delta', 'wb').close()
+            elif self.grids.tick > self.tick:
+                append_delta(self.grids, self.path + '.delta', self.tick)
+            self.tick = self.grids.tick
+        self.saves += 1
+        self._last = time.time()
+
+class histogram():
+    '''Latency histogram with cumulative Prometheus style buckets, bounds in seconds'''
+    bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1) # last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q quantile, max for the +Inf bucket'''
+        rank = q * self.count
+        seen = 0
+        for i in range(len(self.bounds)):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(self.bounds[i], self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'mean_ms': round(self.sum / self.count * 1000, 3) if self.count else 0,
+                'p50_ms': round(self.quantile(0.5) * 1000, 3), 'p95_ms': round(self.quantile(0.95) * 1000, 3),
+                'max_ms': round(self.max * 1000, 3)}
+
+class metrics():
+    '''
+    Stage timers and counters. enable() wraps the methods listed in STAGES with timing wrappers and
+    disable() puts the originals back, so a disabled registry costs nothing on the hot paths.
+    write() saves everything as JSON, or as Prometheus text when the path ends in .prom or .txt,
+    start_export() rewrites that file every interval seconds on a background thread.
+    '''
+    def __init__(self):
+        self.timers = {} # stage -> histogram
+        self.counters = collections.defaultdict(int)
+        self.enabled = False
+        self._originals = []
+        self._exporter = None
+        self._lock = threading.Lock() # the snapshot laser fetch records from its own thread
+
+    def timer(self, stage):
+        if stage not in self.timers:
+            self.timers[stage] = histogram()
+        return self.timers[stage]
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def wrap(self, function, stage, counter):
+        '''Timing wrapper for a method, stage may be a function of the call arguments giving the stage name'''
+        timer = None if callable(stage) else self.timer(stage)
+        def timed(obj, *args, **kwargs):
+            t0 = time.time()
+            try:
+                return function(obj, *args, **kwargs)
+            finally:
+                elapsed = time.time() - t0
+                with self._lock:
+                    (timer or self.timer(stage(args))).observe(elapsed)
+                    if counter is not None:
+                        counter(self, obj, args)
+        timed.__name__ = function.__name__
+        timed.__doc__ = function.__doc__
+        return timed
+
+    def enable(self):
+        if self.enabled:
+            return
+        for owner, name, stage, counter in STAGES:
+            original = owner.__dict__[name]
+            self._originals.append((owner, name, original))
+            setattr(owner, name, self.wrap(original, stage, counter))
+        self.enabled = True
 
+    def disable(self):
+        for owner, name, original in reversed(self._originals):
+            setattr(owner, name, original)
+        self._originals = []
+        self.enabled = False
 
-    newGrid = gridmap(a,b,c,d)
+    def reset(self):
+        for stage in self.timers:
+            self.timers[stage].__init__()
+        self.counters.clear()
+
+    def snapshot(self):
+        return {'timestamp': time.time(),
+                'stages': dict((stage, timer.summary()) for stage, timer in self.timers.items()),
+                'counters': dict(self.counters)}
+
+    def prometheus(self):
+        '''All timers and counters in the Prometheus text exposition format'''
+        lines = ['# TYPE mapper_stage_seconds histogram']
+        for stage in sorted(self.timers):
+            timer = self.timers[stage]
+            cumulative = 0
+            for bound, count in zip(timer.bounds + ('+Inf',), timer.counts):
+                cumulative += count
+                lines.append('mapper_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, cumulative))
+            lines.append('mapper_stage_seconds_sum{stage="%s"} %r' % (stage, timer.sum))
+            lines.append('mapper_stage_seconds_count{stage="%s"} %d' % (stage, timer.count))
+        for name in sorted(self.counters):
+            lines.append('# TYPE mapper_%s_total counter' % name)
+            lines.append('mapper_%s_total %d' % (name, self.counters[name]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''Write the metrics beside path and rename over it, readers never see a partial file'''
+        if path.endswith('.prom') or path.endswith('.txt'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=1, sort_keys=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        replace_file(tmp, path)
+
+    def start_export(self, path, interval=5.0):
+        '''Rewrite path every interval seconds until stop_export'''
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                self.write(path)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self._exporter = (stop, thread, path)
+
+    def stop_export(self):
+        '''Stop the exporter thread and write the final metrics'''
+        if self._exporter is not None:
+            stop, thread, path = self._exporter
+            stop.set()
+            thread.join()
+            self.write(path)
+            self._exporter = None
+
+    def profile(self, cycles, path='mapper.prof'):
+        '''
+        Run cProfile over the next cycles calls of robot.go and dump the stats to path
+        (read them with pstats), then uninstall the hook.
+        '''
+        import cProfile
+        profiler = cProfile.Profile()
+        original = robot.__dict__['go']
+        state = {'left': cycles}
+        def go(bot, gridsmap):
+            profiler.enable()
+            try:
+                return original(bot, gridsmap)
+            finally:
+                profiler.disable()
+                state['left'] -= 1
+                if state['left'] <= 0:
+                    robot.go = original
+                    profiler.dump_stats(path)
+        go.__doc__ = original.__doc__
+        robot.go = go
+
+def _http_stage(args):
+    return 'http_' + args[1].rsplit('/', 1)[-1] # http_localization, http_echoes, http_differentialdrive
+
+def _count_http(registry, client, args):
+    registry.count('http_calls')
+
+def _count_cells(registry, grids, args):
+    registry.count('scans')
+    registry.count('cells_updated', grids.cells_updated)
+
+def _count_planner(registry, grids, args):
+    planner = args[2] if len(args) > 2 and args[2] is not None else grids.planner
+    registry.count('planner_expansions', planner.expansions)
+
+def _count_frontier(registry, grids, args):
+    registry.count('frontier_expansions', grids.search_expansions)
+
+# (class, method, stage, counter) wrapped by metrics.enable
+STAGES = [
+    (lokarria, 'request', _http_stage, _count_http),
+    (lokarria, 'get_snapshot', 'snapshot', None),
+    (robot, 'scan', 'scan', None),
+    (robot, 'update_map', 'update_map', None),
+    (gridmap, 'update', 'update', _count_cells),
+    (robot, 'find_target', 'find_target', None),
+    (gridmap, 'nearest_frontier', 'nearest_frontier', _count_frontier),
+    (robot, 'search_path', 'search_path', None),
+    (gridmap, 'search_path', 'plan', _count_planner),
+    (gridmap, 'show', 'show', None),
+    (robot, 'follow_path', 'follow_path', None),
+    (robot, 'go', 'cycle', None),
+]
+
+METRICS = metrics() # disabled until METRICS.enable()
+
+def parse_args(argv):
+    '''
+    Command line of Mapper.py, argv without the program name:
+      URL[,URL...] a b c d [backend] [log]   explore the area with corners a b c d (metres), one robot
+                                             per url, recording the sensors of a single robot to log
+      replay LOG a b c d [backend]           rebuild a map from a sensor log as fast as possible
+    '''
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--resolution', type=float,
+                        help="cell size in metres (default 0.5, the checkpoint's with --resume)")
+    common.add_argument('--block-size', type=float,
+                        help="planning block size in metres (default 1, the checkpoint's with --resume)")
+    common.add_argument('--plan-level', type=int, default=0,
+                        help='search frontiers and plan coarse to fine from this pyramid level, the target is then only '
+                             'the nearest at that level and small maps explore slower (default 0, blocks only)')
+    common.add_argument('--output', default='png', choices=MAP_OUTPUTS + ['none'],
+                        help='map output: png or npy dumps need no imaging library, matplotlib is only imported '
+                             'for matplotlib (default png)')
+    common.add_argument('--map', metavar='FILE', help='map output file (default MAP.<output>)')
+    common.add_argument('--metrics', metavar='FILE', help='export timers and counters, .json, .prom or .txt')
+    common.add_argument('--profile', metavar='CYCLES', type=int, help='profile the first CYCLES calls of robot.go')
+    common.add_argument('--startup', action='store_true', help='print the time from loading Mapper.py to exploring')
+    if argv[:1] == ['replay']:
+        parser = argparse.ArgumentParser(prog='Mapper.py replay', parents=[common],
+                                         description='Rebuild a map from a sensor log')
+        parser.add_argument('log', help='sensor log written by an exploration run')
+        argv = argv[1:]
+    else:
+        parser = argparse.ArgumentParser(prog='Mapper.py', parents=[common],
+                                         description='Explore an area with MRDS robots and map it',
+                                         epilog='Mapper.py replay --help shows how to replay a sensor log')
+        parser.add_argument('url', help='Lokarria address, several comma separated run a fleet on one map')
+    for corner, text in [('a', 'lower left x'), ('b', 'lower left y'), ('c', 'upper right x'), ('d', 'upper right y')]:
+        parser.add_argument(corner, type=int, help='map corner, %s in metres' % text)
+    parser.add_argument('backend', nargs='?', default='list', choices=['list', 'numpy', 'tiled'],
+                        help='gridmap backend (default list)')
+    if parser.prog == 'Mapper.py':
+        parser.add_argument('log', nargs='?', help='record the sensors of a single robot to this sensor log')
+        parser.add_argument('--pipeline', action='store_true', help='integrate scans on background threads')
+        parser.add_argument('--checkpoint', metavar='FILE', help='checkpoint the map to FILE while exploring')
+        parser.add_argument('--checkpoint-interval', metavar='SECONDS', type=float, default=30.0,
+                            help='seconds between checkpoints (default 30)')
+        parser.add_argument('--resume', action='store_true',
+                            help='resume from the checkpoint (default MAP.ckpt), the map layout given must match it')
+    args = parser.parse_args(argv)
+    args.replay = parser.prog != 'Mapper.py'
+    if args.map is None and args.output != 'none':
+        args.map = 'MAP.' + args.output.replace('matplotlib', 'png')
+    if not args.replay and args.resume and args.checkpoint is None:
+        args.checkpoint = 'MAP.ckpt'
+    if args.replay or not args.resume: # a resumed map takes them from the checkpoint unless given
+        args.resolution = 0.5 if args.resolution is None else args.resolution
+        args.block_size = 1.0 if args.block_size is None else args.block_size
+    return args
+
+def layout_mismatch(grids, corners, resolution=None, block_size=None):
+    '''Describe how a map differs from the given corners, resolution and block size, None if it matches'''
+    have = (grids.lower_left_x, grids.lower_left_y, grids.upper_right_x, grids.upper_right_y)
+    if tuple(have) != tuple(corners):
+        return 'corners %s, not %s' % (have, tuple(corners))
+    if resolution is not None and grids.resolution != resolution:
+        return 'resolution %g m, not %g m' % (grids.resolution, resolution)
+    if block_size is not None and grids.block_cells != max(int(round(block_size / grids.resolution)), 1):
+        return 'blocks of %g m, not %g m' % (grids.block_cells * grids.resolution, block_size)
+    return None
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.metrics:
+        METRICS.enable()
+        METRICS.start_export(args.metrics)
+    if args.profile:
+        METRICS.profile(args.profile)
+    corners = (args.a, args.b, args.c, args.d)
+
+    if args.replay:
+        newGrid = gridmap(*corners, backend=args.backend, resolution=args.resolution, block_size=args.block_size)
+        t0 = time.time()
+        bot = replay(args.log, newGrid, plan_level=args.plan_level)
+        print 'Replayed', newGrid.tick, 'scans in', time.time() - t0, 's', bot.client.stats()
+        if args.output != 'none':
+            map_renderer(args.map, mode=args.output).close(newGrid.grid)
+        METRICS.stop_export()
+        sys.exit(0)
+    urls = [url.replace('http://', '').rstrip('/') for url in args.url.split(',')]
+    MRDS_URL = urls[0]
+
+    if args.resume:
+        t0 = time.time()
+        newGrid = load_checkpoint(args.checkpoint, args.backend)
+        mismatch = layout_mismatch(newGrid, corners, args.resolution, args.block_size)
+        if mismatch is not None:
+            sys.exit('Mapper.py: error: %s holds a map with %s' % (args.checkpoint, mismatch))
+        print 'Resumed', args.checkpoint, 'at scan', newGrid.tick, 'in', time.time() - t0, 's'
+    else:
+        newGrid = gridmap(*corners, backend=args.backend, resolution=args.resolution, block_size=args.block_size)
+    saver = checkpointer(newGrid, args.checkpoint, args.checkpoint_interval) if args.checkpoint else None
+    if args.output != 'none':
+        newGrid.renderer = map_renderer(args.map, fps=0.5, mode=args.output)
     print len(newGrid.blocks),len(newGrid.blocks[0])
     #newGrid.show()
     
-    print 'Sending commands to MRDS server', MRDS_URL
+    print 'Sending commands to MRDS server', ','.join(urls)
     
+    if len(urls) > 1: # several robots share the map
+        robots = [robot(lokarria(url)) for url in urls]
+        for bot in robots:
+            bot.plan_level = args.plan_level
+        if args.pipeline:
+            for bot in robots:
+                bot.pipeline = map_pipeline(newGrid, bot.client, bot.rate).start()
+        if args.startup:
+            print 'Started in', time.time() - START_TIME, 's'
+        team = fleet(newGrid, robots).start()
+        while not team.join(5):
+            if saver is not None:
+                saver.maybe()
+            newGrid.show()
+            print 'Fleet cycles:', team.cycles, 'Targets:', team.claims.values()
+        print 'No reachable frontier left'
+        for bot in robots:
+            if bot.pipeline is not None:
+                bot.pipeline.stop()
+        if saver is not None:
+            saver.save(full=True)
+        if newGrid.renderer is not None:
+            newGrid.renderer.close(newGrid.grid)
+        METRICS.stop_export()
+        sys.exit(0)
+
     newROBO = robot()
+    newROBO.plan_level = args.plan_level
+    if args.log:
+        newROBO.client.recorder = sensor_log(args.log)
+    if args.pipeline:
+        newROBO.pipeline = map_pipeline(newGrid, newROBO.client, newROBO.rate).start()
+    if args.startup:
+        print 'Started in', time.time() - START_TIME, 's'
 
-    
     t1 = time.time()
-    while (1):
-        newROBO.go(newGrid)
+    while newROBO.go(newGrid):
+        newGrid.show() # the renderer keeps to its own frame rate
+        if saver is not None:
+            saver.maybe()
         t2 = time.time()
         if t2 - t1 > 5:
             t1 = t2
-            newGrid.show()
+            print 'Connections:', newROBO.client.stats(), 'Control loop:', newROBO.loop and newROBO.loop.stats(),
+            print 'Pipeline:', newROBO.pipeline and newROBO.pipeline.stats(), 'Scans:', newROBO.gate_stats()
 
-    
-    newGrid.show()
-    
-    
-   
-    
-    
\ No newline at end of file
+    print 'No reachable frontier left'
+    if newROBO.pipeline is not None:
+        newROBO.pipeline.stop()
+    if saver is not None:
+        saver.save(full=True)
+    if newGrid.renderer is not None:
+        newGrid.renderer.close(newGrid.grid)
+    METRICS.stop_export()
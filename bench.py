@@ -0,0 +1,384 @@
+"""
+Benchmarks for the mapping hot paths of Mapper.py, no MRDS server needed.
+The robot benchmarks run against fake_lokarria worlds of several sizes.
+
+Usage: python bench.py [scans] [go]
+  scans  number of scans or plans per benchmark (default 200)
+  go     also time whole robot.go exploration runs up to 90% coverage (slow)
+"""
+
+import os, random, subprocess, sys, time
+from math import sin, cos, atan2, radians, pi
+
+import Mapper
+
+try:
+    import fake_lokarria
+except ImportError: # the fake server needs numpy
+    fake_lokarria = None
+
+
+LASER = {'StartAngle': -3 * pi / 4, 'EndAngle': 3 * pi / 4, 'AngleIncrement': pi / 180}
+
+
+def random_scans(grids, count, seed=0):
+    '''Beam end points plus robot coordinate for random poses, as robot.update_map produces them'''
+    rnd = random.Random(seed)
+    scans = []
+    for n in range(count):
+        x = rnd.uniform(grids.lower_left_x + 1, grids.upper_right_x - 1)
+        y = rnd.uniform(grids.lower_left_y + 1, grids.upper_right_y - 1)
+        heading = rnd.uniform(-180, 180)
+        area = []
+        for i in range(271):
+            d = rnd.uniform(0.5, 20)
+            beta = radians(heading - 135 + i)
+            px = min(max(x + d * cos(beta), grids.lower_left_x), grids.upper_right_x - 0.1)
+            py = min(max(y + d * sin(beta), grids.lower_left_y + 0.1), grids.upper_right_y)
+            area.append(Mapper.pos2coor([px, py], grids))
+        area.append(Mapper.pos2coor([x, y], grids))
+        scans.append(area)
+    return scans
+
+
+def bench_update(corners, count):
+    '''Scans per second of gridmap.update for each available backend'''
+    scans = random_scans(Mapper.gridmap(*corners), count)
+    backends = ['list'] + (['numpy'] if Mapper.np is not None else [])
+    results = {}
+    for backend in backends:
+        grids = Mapper.gridmap(*(corners + (backend,)))
+        t0 = time.time()
+        for area in scans:
+            grids.update(area)
+        results[backend] = count / (time.time() - t0)
+    return results
+
+
+def bench_trace(corners, count):
+    '''Scans per second of batch ray traversal with trace_rays'''
+    grids = Mapper.gridmap(*(corners + ('numpy',)))
+    scans = [Mapper.np.asarray(area) for area in random_scans(grids, count)]
+    t0 = time.time()
+    for area in scans:
+        Mapper.trace_rays(area[-1], area[:-1], grids.grid.shape)
+    return count / (time.time() - t0)
+
+
+def bench_plan(corners, count, scans=100):
+    '''Plans per second and mean node expansions of each planner on a map built from random scans'''
+    grids = Mapper.gridmap(*corners)
+    for area in random_scans(grids, scans):
+        grids.update(area)
+    occupied = grids.occupancy()
+    free = [(r, c) for r in range(grids.block_rows) for c in range(grids.block_cols) if not occupied[r][c]]
+    rnd = random.Random(1)
+    pairs = [(rnd.choice(free), rnd.choice(free)) for n in range(count)]
+    results = {}
+    for name, planner in [('wavefront', Mapper.wavefront()), ('astar', Mapper.astar()), ('astar8', Mapper.astar(True)),
+                          ('coarse', Mapper.coarse_to_fine())]:
+        expansions = 0
+        t0 = time.time()
+        for start, target in pairs:
+            planner.plan(grids, start, target)
+            expansions += planner.expansions
+        results[name] = (count / (time.time() - t0), float(expansions) / count)
+    return results
+
+
+def bench_resolution(corners, count, resolutions=(0.5, 0.25, 0.1)):
+    '''Scans per second of the numpy backend and plans per second of astar and coarse_to_fine at several cell sizes'''
+    results = {}
+    for resolution in resolutions:
+        grids = Mapper.gridmap(*(corners + ('numpy', resolution)))
+        scans = [Mapper.np.asarray(area) for area in random_scans(grids, count)]
+        t0 = time.time()
+        for area in scans:
+            grids.update(area)
+        rate = count / (time.time() - t0)
+        occupied = grids.occupancy()
+        free = [(r, c) for r in range(grids.block_rows) for c in range(grids.block_cols) if not occupied[r][c]]
+        rnd = random.Random(1)
+        pairs = [(rnd.choice(free), rnd.choice(free)) for n in range(max(count // 10, 5))]
+        plans = []
+        for planner in [Mapper.astar(), Mapper.coarse_to_fine()]:
+            t0 = time.time()
+            for start, target in pairs:
+                grids.search_path(start, target, planner)
+            plans.append(len(pairs) / (time.time() - t0))
+        results[resolution] = (rate, plans[0], plans[1])
+    return results
+
+
+def bench_memory(corners, explored, count):
+    '''Cell layer megabytes and scans per second when only an explored-sized corner of a big map is scanned'''
+    area_map = Mapper.gridmap(*explored)
+    scans = [Mapper.np.asarray(area) for area in random_scans(area_map, count)]
+    results = {}
+    for backend in ['numpy', 'tiled']:
+        grids = Mapper.gridmap(*(corners + (backend,)))
+        t0 = time.time()
+        for area in scans:
+            grids.update(area)
+        results[backend] = (grids.nbytes() / 1e6, count / (time.time() - t0))
+    return results
+
+
+def bench_startup(runs=5):
+    '''
+    Best wall seconds of a fresh interpreter importing Mapper and printing the Mapper.py help,
+    next to importing matplotlib.pyplot alone.
+    '''
+    commands = {'import': ['-c', 'import Mapper'], 'help': ['Mapper.py', '--help'],
+                'matplotlib': ['-c', 'import matplotlib.pyplot']}
+    here = os.path.dirname(os.path.abspath(__file__))
+    devnull = open(os.devnull, 'w')
+    results = {}
+    for name, command in commands.items():
+        best = None
+        for n in range(runs):
+            t0 = time.time()
+            if subprocess.call([sys.executable] + command, cwd=here, stdout=devnull, stderr=subprocess.STDOUT):
+                best = None # matplotlib is not installed
+                break
+            elapsed = time.time() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+    devnull.close()
+    return results
+
+
+def bench_pose(count, seed=0):
+    '''
+    Poses per second turned into headings and grid cells: through the quaternion dicts of rotate,
+    through pose2d, and as whole arrays with yaw_array and pos2coor_array.
+    '''
+    rnd = random.Random(seed)
+    grids = Mapper.gridmap(-10, -10, 10, 10)
+    poses = []
+    for n in range(count):
+        yaw = rnd.uniform(-pi, pi)
+        poses.append({'Pose': {'Position': {'X': rnd.uniform(-9, 9), 'Y': rnd.uniform(-9, 9), 'Z': 0.0},
+                               'Orientation': {'W': cos(yaw / 2), 'X': 0.0, 'Y': 0.0, 'Z': sin(yaw / 2)}}})
+    results = {}
+    t0 = time.time()
+    for pose in poses:
+        v = Mapper.rotate(pose['Pose']['Orientation'], {'X': 1.0, 'Y': 0.0, 'Z': 0.0})
+        atan2(v['Y'], v['X'])
+        Mapper.pos2coor([pose['Pose']['Position']['X'], pose['Pose']['Position']['Y']], grids)
+    results['dict'] = count / (time.time() - t0)
+    t0 = time.time()
+    for pose in poses:
+        p = Mapper.pose2d.from_lokarria(pose)
+        Mapper.pos2coor([p.x, p.y], grids)
+    results['pose2d'] = count / (time.time() - t0)
+    if Mapper.np is not None:
+        table = Mapper.np.array([(p['Pose']['Position']['X'], p['Pose']['Position']['Y'], p['Pose']['Orientation']['W'],
+                                  p['Pose']['Orientation']['X'], p['Pose']['Orientation']['Y'], p['Pose']['Orientation']['Z'])
+                                 for p in poses])
+        t0 = time.time()
+        Mapper.yaw_array(table[:, 2:6])
+        Mapper.pos2coor_array(table[:, 0:2], grids)
+        results['array'] = count / (time.time() - t0)
+    return results
+
+
+def bench_find_target(corners, count, scans=None):
+    '''
+    Frontier queries per second from random free blocks of a partly explored map, by default one
+    random scan per 1000 square metres, on the block map and from pyramid level 2.
+    Returns both rates and the number of frontiers, None if the scans left no frontier to search for.
+    '''
+    grids = Mapper.gridmap(*corners)
+    if scans is None:
+        scans = max(2, int((grids.width * grids.height) // 1000))
+    for area in random_scans(grids, scans):
+        grids.update(area)
+    if not grids.frontiers:
+        return None
+    occupied = grids.occupancy()
+    free = [(r, c) for r in range(grids.block_rows) for c in range(grids.block_cols) if not occupied[r][c]]
+    rnd = random.Random(2)
+    starts = [rnd.choice(free) for n in range(count)]
+    t0 = time.time()
+    for start in starts:
+        grids.nearest_frontier(start)
+    t1 = time.time()
+    for start in starts:
+        grids.nearest_frontier(start, level=2)
+    t2 = time.time()
+    return count / (t1 - t0), count / (t2 - t1), len(grids.frontiers)
+
+
+def bench_scan(size, count):
+    '''robot.scan plus robot.update_map per second on each backend, fed with one fake laser snapshot'''
+    truth = fake_lokarria.rooms_world(*size)
+    sim = fake_lokarria.fake_lokarria(truth)
+    snap = Mapper.snapshot(time.time(), sim.pose(), sim.echoes())
+    results = {}
+    for backend in ['list', 'numpy']:
+        grids = Mapper.gridmap(*(truth.corners() + (backend,)))
+        bot = Mapper.robot()
+        bot.laser = Mapper.laser_geometry(sim.properties)
+        bot.snapshot = snap
+        bot.get_position(snap)
+        bot.get_coor(grids)
+        bot.get_orientation(snap)
+        t0 = time.time()
+        for n in range(count):
+            bot.scan(grids)
+            bot.update_map(grids)
+        results[backend] = count / (time.time() - t0)
+    sim.server.server_close()
+    return results
+
+
+def coverage(grids, truth):
+    '''Fraction of the free cells of the ground truth that the map knows'''
+    rows, cols = grids.grid.shape
+    x = grids.lower_left_x + (Mapper.np.arange(cols) + 0.5) * grids.resolution
+    y = grids.upper_right_y - (Mapper.np.arange(rows) + 0.5) * grids.resolution
+    free = ~truth.is_occupied(*Mapper.np.meshgrid(x, y))
+    return float(Mapper.np.asarray(grids.known_area)[free].mean())
+
+
+def bench_go(size, speedup=10.0, goal=0.9, limit=60, pipeline=False, gate=True):
+    '''
+    Run robot.go against a fake world until goal coverage, no frontier left or limit wall seconds,
+    integrating scans inline or on a map_pipeline, gated or every snapshot.
+    Returns cycles per second, simulated seconds to the final coverage, that coverage, the control loop
+    stats and the scan gate counts.
+    '''
+    truth = fake_lokarria.rooms_world(*size)
+    sim = fake_lokarria.fake_lokarria(truth, speedup=speedup).start()
+    grids = Mapper.gridmap(*(truth.corners() + ('numpy',)))
+    grids.renderer = Mapper.map_renderer('bench_map.png', fps=1)
+    bot = Mapper.robot(Mapper.lokarria(sim.url))
+    bot.sleep = lambda t: time.sleep(t / speedup)
+    bot.clock = lambda: time.time() * speedup
+    if pipeline:
+        bot.pipeline = Mapper.map_pipeline(grids, bot.client, bot.rate)
+    mapper = bot.pipeline.mapper if pipeline else bot # the robot integrating the scans
+    mapper.gate_interval /= speedup # snapshot timestamps are wall clock
+    if not gate:
+        mapper.gate_distance = 0
+    if pipeline:
+        bot.pipeline.sleep = bot.sleep
+        bot.pipeline.start()
+    cycles = 0
+    reached = 0
+    t0 = time.time()
+    while time.time() - t0 < limit:
+        cycles += 1
+        if not bot.go(grids):
+            break
+        grids.show()
+        reached = coverage(grids, truth)
+        if reached >= goal:
+            break
+    elapsed = time.time() - t0
+    if pipeline:
+        bot.pipeline.stop()
+    grids.renderer.close()
+    bot.client.close()
+    sim.stop()
+    return cycles / elapsed, elapsed * speedup, reached, bot.loop and bot.loop.stats(), mapper.gate_stats()
+
+
+def start_spots(truth, count, seed=0):
+    '''count free spots with a free 1 m square around them, spread over the world'''
+    rnd = random.Random(seed)
+    spots = []
+    while len(spots) < count:
+        x = rnd.uniform(truth.x0 + 1, truth.x0 + truth.width - 1)
+        y = rnd.uniform(truth.y0 + 1, truth.y0 + truth.height - 1)
+        if not truth.is_occupied([x - 0.5, x + 0.5, x, x, x], [y, y, y - 0.5, y + 0.5, y]).any():
+            spots.append((x, y))
+    return spots
+
+
+def bench_fleet(size, robots, speedup=10.0, goal=0.9, limit=60):
+    '''
+    Explore one fake world with a fleet of robots, one fake server each, sharing one numpy gridmap.
+    Returns simulated seconds to the final coverage and that coverage.
+    '''
+    truth = fake_lokarria.rooms_world(*size)
+    sims = [fake_lokarria.fake_lokarria(truth, x, y, speedup=speedup).start() for x, y in start_spots(truth, robots)]
+    grids = Mapper.gridmap(*(truth.corners() + ('numpy',)))
+    grids.renderer = Mapper.map_renderer('bench_map.png', fps=1)
+    bots = []
+    for sim in sims:
+        bot = Mapper.robot(Mapper.lokarria(sim.url))
+        bot.sleep = lambda t: time.sleep(t / speedup)
+        bot.clock = lambda: time.time() * speedup
+        bots.append(bot)
+    team = Mapper.fleet(grids, bots).start()
+    reached = 0
+    t0 = time.time()
+    while team.running() and time.time() - t0 < limit:
+        team.join(0.2)
+        reached = coverage(grids, truth)
+        if reached >= goal:
+            break
+    elapsed = time.time() - t0
+    team.stop()
+    team.join(30)
+    grids.renderer.close()
+    for bot, sim in zip(bots, sims):
+        bot.client.close()
+        sim.stop()
+    return elapsed * speedup, reached
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for corners in [(-10, -10, 10, 10), (-40, -20, 40, 20), (-100, -100, 100, 100)]:
+        results = bench_update(corners, count)
+        line = 'gridmap.update %-22s' % (corners,)
+        for backend in sorted(results):
+            line += '  %s %8.1f scans/s' % (backend, results[backend])
+        if 'numpy' in results:
+            line += '  (x%.1f)' % (results['numpy'] / results['list'])
+        print line
+    for corners in [(-10, -10, 10, 10), (-100, -100, 100, 100)]:
+        results = bench_plan(corners, max(count // 10, 5))
+        line = 'search_path    %-22s' % (corners,)
+        for name in ['wavefront', 'astar', 'astar8', 'coarse']:
+            line += '  %s %8.1f plans/s (%d nodes)' % ((name,) + results[name])
+        print line
+    if Mapper.np is not None:
+        for corners in [(-10, -10, 10, 10), (-100, -100, 100, 100)]:
+            print 'ray tracing    %-22s  %8.1f scans/s' % (corners, bench_trace(corners, count))
+    if Mapper.np is not None:
+        results = bench_resolution((-40, -20, 40, 20), count)
+        for resolution in sorted(results, reverse=True):
+            print 'resolution     %-22s  %4.2f m %8.1f scans/s  astar %8.1f plans/s  coarse %8.1f plans/s' % (
+                (-40, -20, 40, 20), resolution, results[resolution][0], results[resolution][1], results[resolution][2])
+        results = bench_memory((-500, -500, 500, 500), (-500, 460, -440, 500), count)
+        print 'map memory     %-22s  numpy %7.2f MB %7.1f scans/s  tiled %7.2f MB %7.1f scans/s' % (
+            (-500, -500, 500, 500), results['numpy'][0], results['numpy'][1], results['tiled'][0], results['tiled'][1])
+    results = bench_startup()
+    print 'startup        %-22s  import %6.3f s  --help %6.3f s  (matplotlib.pyplot alone %s)' % (
+        '', results['import'], results['help'], '%.3f s' % results['matplotlib'] if results['matplotlib'] else 'missing')
+    results = bench_pose(count * 500)
+    print 'pose           %-22s  dict %10.0f poses/s  pose2d %10.0f poses/s  array %10.0f poses/s' % (
+        count * 500, results['dict'], results['pose2d'], results.get('array', 0))
+    for corners in [(-10, -10, 10, 10), (-100, -100, 100, 100)]:
+        results = bench_find_target(corners, count)
+        if results is not None:
+            print 'find_target    %-22s  %8.1f queries/s  level 2 %8.1f queries/s (%d frontiers)' % ((corners,) + results)
+    if fake_lokarria is not None:
+        for size in [(20, 20), (40, 30), (80, 60)]:
+            results = bench_scan(size, count)
+            print 'robot.scan     %-22s  list %8.1f scans/s  numpy %8.1f scans/s' % (size, results['list'], results['numpy'])
+        if 'go' in sys.argv[2:]:
+            for size in [(20, 20), (40, 30)]:
+                for pipeline, gate in [(False, False), (False, True), (True, True)]:
+                    rate, simulated, reached, loop, gated = bench_go(size, pipeline=pipeline, gate=gate)
+                    print 'robot.go       %-22s  %-8s %-6s %6.2f cycles/s  %7.1f s simulated to %.0f%% coverage  %s  %s' % (
+                        size, pipeline and 'pipeline' or 'inline', gate and 'gated' or 'every', rate, simulated,
+                        100 * reached, loop, gated)
+            for size in [(40, 30)]:
+                for robots in [1, 2, 4]:
+                    simulated, reached = bench_fleet(size, robots)
+                    print 'fleet          %-22s  %d robots  %7.1f s simulated to %.0f%% coverage' % (size, robots, simulated, 100 * reached)
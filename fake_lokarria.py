@@ -0,0 +1,256 @@
+"""
+Stand-in for the MRDS Lokarria http interface, for running Mapper.py without the simulator.
+
+A differential drive robot moves in a ground-truth occupancy image and its laser is ray-cast
+against it. Serves /lokarria/localization, /lokarria/laser/echoes, /lokarria/laser/properties
+and /lokarria/differentialdrive.
+
+Usage: python fake_lokarria.py [port] [world.pgm|world.txt resolution x0 y0]
+"""
+
+import BaseHTTPServer, SocketServer, json, random, sys, threading, time
+from math import sin, cos, pi, floor
+
+import numpy as np
+
+
+class world():
+    '''
+    Ground-truth occupancy image, True where a cell is occupied.
+    Row 0 is the top of the map, (x0, y0) the lower left corner in metres.
+    '''
+    def __init__(self, occupied, resolution, x0, y0):
+        self.occupied = np.asarray(occupied, dtype=bool)
+        self.resolution = resolution
+        self.x0 = x0
+        self.y0 = y0
+        self.width = self.occupied.shape[1] * resolution
+        self.height = self.occupied.shape[0] * resolution
+
+    def corners(self):
+        '''Map bounds as gridmap takes them'''
+        return (int(floor(self.x0)), int(floor(self.y0)),
+                int(floor(self.x0 + self.width)), int(floor(self.y0 + self.height)))
+
+    def cells(self, x, y):
+        '''Row and column arrays of world positions, -1 outside the image'''
+        cols = np.floor((np.asarray(x) - self.x0) / self.resolution).astype(np.intp)
+        rows = self.occupied.shape[0] - 1 - np.floor((np.asarray(y) - self.y0) / self.resolution).astype(np.intp)
+        outside = (rows < 0) | (rows >= self.occupied.shape[0]) | (cols < 0) | (cols >= self.occupied.shape[1])
+        rows[outside] = -1
+        cols[outside] = -1
+        return rows, cols
+
+    def is_occupied(self, x, y):
+        '''Occupancy at world positions, everything outside the image counts as occupied'''
+        rows, cols = self.cells(x, y)
+        return (rows < 0) | self.occupied[np.maximum(rows, 0), np.maximum(cols, 0)]
+
+    def free_at(self, x, y):
+        return not bool(self.is_occupied([x], [y])[0])
+
+    def cast(self, x, y, angles, max_range):
+        '''Distance to the first occupied cell along each angle, max_range if nothing is hit'''
+        d = np.arange(0, max_range, self.resolution / 2.0)
+        xs = x + np.outer(np.cos(angles), d)
+        ys = y + np.outer(np.sin(angles), d)
+        hit = self.is_occupied(xs, ys)
+        first = hit.argmax(axis=1)
+        return np.where(hit.any(axis=1), d[first], max_range)
+
+
+def load_world(path, resolution=0.1, x0=0.0, y0=0.0):
+    '''Read a binary PGM (P5, dark pixels occupied) or a text map ('#' occupied)'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(b'P5'):
+        fields = []
+        i = 2
+        while len(fields) < 3:
+            while data[i:i + 1].isspace():
+                i += 1
+            if data[i:i + 1] == b'#':
+                i = data.index(b'\n', i)
+                continue
+            j = i
+            while not data[j:j + 1].isspace():
+                j += 1
+            fields.append(int(data[i:j]))
+            i = j
+        cols, rows, maxval = fields
+        pixels = np.frombuffer(data[i + 1:i + 1 + rows * cols], dtype=np.uint8).reshape(rows, cols)
+        return world(pixels < maxval // 2, resolution, x0, y0)
+    lines = [line.rstrip('\r\n') for line in data.decode('ascii').splitlines() if line.strip()]
+    cols = max(len(line) for line in lines)
+    return world([[c == '#' for c in line.ljust(cols)] for line in lines], resolution, x0, y0)
+
+
+def rooms_world(width, height, room=8, resolution=0.1, seed=0):
+    '''
+    A width x height metre world centred on the origin, split into rooms of about room metres
+    connected by 2 m doors, with a few boxes in the rooms.
+    '''
+    rnd = random.Random(seed)
+    rows = int(height / resolution); cols = int(width / resolution)
+    occupied = np.zeros((rows, cols), dtype=bool)
+    wall = max(int(0.2 / resolution), 1)
+    door = int(2 / resolution)
+    occupied[:wall, :] = occupied[-wall:, :] = True
+    occupied[:, :wall] = occupied[:, -wall:] = True
+    step = int(room / resolution)
+    for c in range(step, cols - wall, step):
+        occupied[:, c:c + wall] = True
+        for r in range(0, rows, step):
+            gap = r + rnd.randint(wall, max(step - door - wall, wall))
+            occupied[gap:gap + door, c:c + wall] = False
+    for r in range(step, rows - wall, step):
+        occupied[r:r + wall, :] = True
+        for c in range(0, cols, step):
+            gap = c + rnd.randint(wall, max(step - door - wall, wall))
+            occupied[r:r + wall, gap:gap + door] = False
+    for n in range(int(width * height / 50)):
+        size = int(rnd.uniform(0.4, 1.0) / resolution)
+        r = rnd.randint(wall, rows - size - wall); c = rnd.randint(wall, cols - size - wall)
+        occupied[r:r + size, c:c + size] = True
+    return world(occupied, resolution, -width / 2.0, -height / 2.0)
+
+
+class fake_lokarria():
+    '''
+    Lokarria server backed by a world. Time inside the simulation runs speedup times faster than
+    the wall clock, the robot keeps its last commanded speeds and stops at walls.
+    '''
+    def __init__(self, ground_truth, x=None, y=None, yaw=0.0, port=0, speedup=1.0, max_range=20.0):
+        self.world = ground_truth
+        if x is None:
+            x, y = self.free_spot()
+        self.x = x; self.y = y; self.yaw = yaw
+        self.linear = 0.0; self.angular = 0.0
+        self.speedup = speedup
+        self.max_range = max_range
+        self.properties = {'StartAngle': -3 * pi / 4, 'EndAngle': 3 * pi / 4, 'AngleIncrement': pi / 180}
+        self.angles = np.linspace(-3 * pi / 4, 3 * pi / 4, 271)
+        self.requests = 0
+        self._clock = time.time()
+        self._lock = threading.Lock()
+        class handler(lokarria_handler):
+            pass
+        handler.sim = self
+        self.server = threaded_server(('127.0.0.1', port), handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        return '127.0.0.1:%d' % self.server.server_port
+
+    def free_spot(self):
+        '''Centre of the first free 1 m square scanning from the middle of the world'''
+        w = self.world
+        cx = w.x0 + w.width / 2.0; cy = w.y0 + w.height / 2.0
+        for radius in range(int(max(w.width, w.height))):
+            for dx in range(-radius, radius + 1):
+                for dy in (-radius, radius):
+                    x = cx + dx + 0.5; y = cy + dy + 0.5
+                    if not w.is_occupied([x - 0.5, x + 0.5, x, x], [y, y, y - 0.5, y + 0.5]).any() and w.free_at(x, y):
+                        return x, y
+        raise ValueError('no free space in the world')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def advance(self):
+        '''Integrate the drive up to now, in steps of at most 20 ms of simulated time'''
+        now = time.time()
+        elapsed = (now - self._clock) * self.speedup
+        self._clock = now
+        while elapsed > 0:
+            dt = min(elapsed, 0.02)
+            elapsed -= dt
+            yaw = self.yaw + self.angular * dt
+            x = self.x + self.linear * dt * cos((self.yaw + yaw) / 2)
+            y = self.y + self.linear * dt * sin((self.yaw + yaw) / 2)
+            if self.world.free_at(x, y):
+                self.x = x; self.y = y
+            else:
+                self.linear = 0.0 # bumped into a wall
+            self.yaw = (yaw + pi) % (2 * pi) - pi
+
+    def pose(self):
+        with self._lock:
+            self.advance()
+            return {'Pose': {'Position': {'X': self.x, 'Y': self.y, 'Z': 0.0},
+                             'Orientation': {'W': cos(self.yaw / 2), 'X': 0.0, 'Y': 0.0, 'Z': sin(self.yaw / 2)}},
+                    'Timestamp': int(time.time() * 1000)}
+
+    def echoes(self):
+        with self._lock:
+            self.advance()
+            x, y, yaw = self.x, self.y, self.yaw
+        return {'Echoes': self.world.cast(x, y, self.angles + yaw, self.max_range).tolist(),
+                'Timestamp': int(time.time() * 1000)}
+
+    def drive(self, angular, linear):
+        with self._lock:
+            self.advance()
+            self.angular = angular
+            self.linear = linear
+
+
+class lokarria_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real server
+    wbufsize = -1 # send each reply in one piece, unbuffered header writes stall on delayed acks
+    sim = None
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.sim.requests += 1
+        if self.path == '/lokarria/localization':
+            self.reply(200, json.dumps(self.sim.pose()))
+        elif self.path == '/lokarria/laser/echoes':
+            self.reply(200, json.dumps(self.sim.echoes()))
+        elif self.path == '/lokarria/laser/properties':
+            self.reply(200, json.dumps(self.sim.properties))
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        self.sim.requests += 1
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/lokarria/differentialdrive':
+            self.reply(404)
+            return
+        command = json.loads(body)
+        self.sim.drive(command['TargetAngularSpeed'], command['TargetLinearSpeed'])
+        self.reply(204)
+
+
+class threaded_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    if len(sys.argv) > 2:
+        ground_truth = load_world(sys.argv[2], *[float(v) for v in sys.argv[3:6]])
+    else:
+        ground_truth = rooms_world(40, 30)
+    sim = fake_lokarria(ground_truth, port=port)
+    print 'Serving Lokarria on', sim.url, 'map corners', ground_truth.corners()
+    sim.server.serve_forever()
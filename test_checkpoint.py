@@ -0,0 +1,87 @@
+"""
+Tests for the map checkpoint and delta file formats of Mapper.py.
+
+Usage: python -m unittest test_checkpoint
+"""
+
+import os, shutil, tempfile, unittest
+
+import Mapper
+from bench import random_scans
+
+BACKENDS = ['list'] + (['numpy', 'tiled'] if Mapper.np is not None else [])
+
+
+def state(grids):
+    '''Everything a checkpoint has to bring back, comparable across loads'''
+    return (Mapper.layer_bytes(grids.grid), Mapper.layer_bytes(grids.known_area),
+            Mapper.layer_bytes(grids.blocks), grids.tick, sorted(grids.frontiers))
+
+
+class checkpoint_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'MAP.ckpt')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def scanned(self, backend, count, seed=0):
+        '''Small map and count scans to integrate into it'''
+        grids = Mapper.gridmap(-5, -5, 5, 5, backend)
+        return grids, random_scans(grids, count, seed)
+
+    def test_roundtrip(self):
+        for backend in BACKENDS:
+            grids, scans = self.scanned(backend, 9)
+            grids.blocks[2][3] = 1 # visited
+            saver = Mapper.checkpointer(grids, self.path, full_every=4)
+            saver.save()
+            for area in scans:
+                grids.update(area)
+                saver.save()
+                self.assertEqual(state(Mapper.load_checkpoint(self.path, backend)), state(grids), backend)
+
+    def test_skip_old_deltas(self):
+        for backend in BACKENDS:
+            grids, scans = self.scanned(backend, 6)
+            saver = Mapper.checkpointer(grids, self.path)
+            saver.save()
+            for area in scans[:3]:
+                grids.update(area)
+                saver.save()
+            # a crash between writing the checkpoint and emptying the delta file leaves older deltas behind
+            for area in scans[3:]:
+                grids.update(area)
+            Mapper.save_checkpoint(grids, self.path)
+            self.assertTrue(os.path.getsize(self.path + '.delta') > 0)
+            self.assertEqual(state(Mapper.load_checkpoint(self.path, backend)), state(grids), backend)
+
+    def test_truncated_delta(self):
+        for backend in BACKENDS:
+            grids, scans = self.scanned(backend, 3)
+            saver = Mapper.checkpointer(grids, self.path)
+            saver.save()
+            states = [(0, state(grids))] # delta file size after each save and the map it restores
+            for area in scans:
+                grids.update(area)
+                saver.save()
+                states.append((os.path.getsize(self.path + '.delta'), state(grids)))
+            with open(self.path + '.delta', 'rb') as f:
+                deltas = f.read()
+            for cut in range(len(deltas) + 1):
+                with open(self.path + '.delta', 'wb') as f:
+                    f.write(deltas[:cut])
+                expected = [s for size, s in states if size <= cut][-1]
+                self.assertEqual(state(Mapper.load_checkpoint(self.path, backend)), expected,
+                                 '%s cut at %d' % (backend, cut))
+
+    def test_not_a_checkpoint(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x00' * 256)
+        self.assertRaises(ValueError, Mapper.load_checkpoint, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+Tests for the sensor log format of Mapper.py.
+
+Usage: python -m unittest test_sensor_log
+"""
+
+import os, shutil, tempfile, unittest
+from math import sin, cos
+
+import Mapper
+
+
+def pose(x, y, heading):
+    '''Pose in the dict layout Lokarria returns, turned heading radians about Z'''
+    return {'Pose': {'Position': {'X': x, 'Y': y, 'Z': 0.0},
+                     'Orientation': {'W': cos(heading / 2), 'X': 0.0, 'Y': 0.0, 'Z': sin(heading / 2)}}}
+
+
+def records():
+    '''Records of a short drive, echoes are multiples of 0.25 so they survive float32'''
+    result = [(Mapper.LOG_PROPERTIES, 0.0, {'StartAngle': -2.356, 'EndAngle': 2.356, 'AngleIncrement': 0.0174})]
+    for n in range(6):
+        t = 1.0 + n * 0.1
+        result.append((Mapper.LOG_POSE, t, pose(n * 0.5, -n * 0.25, n * 0.3 - 0.6)))
+        result.append((Mapper.LOG_LASER, t + 0.01, {'Echoes': [(n + i) % 80 * 0.25 for i in range(271)]}))
+        result.append((Mapper.LOG_SPEED, t + 0.02, (0.1 * n, 0.5)))
+    return result
+
+
+class sensor_log_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'run.log')
+        self.records = records()
+        self.ends = [] # file size after each record
+        log = Mapper.sensor_log(self.path)
+        for kind, timestamp, data in self.records:
+            if kind == Mapper.LOG_POSE:
+                log.pose(timestamp, data)
+            elif kind == Mapper.LOG_LASER:
+                log.laser(timestamp, data)
+            elif kind == Mapper.LOG_SPEED:
+                log.speed(timestamp, *data)
+            else:
+                log.properties(timestamp, data)
+            log.file.flush()
+            self.ends.append(os.path.getsize(self.path))
+        log.close()
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        self.assertEqual([(kind, timestamp, data if kind != Mapper.LOG_SPEED else tuple(data))
+                          for kind, timestamp, data in Mapper.read_log(self.path)], self.records)
+
+    def test_append(self):
+        log = Mapper.sensor_log(self.path)
+        log.speed(9.0, 0.0, 0.0)
+        log.close()
+        self.assertEqual(list(Mapper.read_log(self.path))[-1], (Mapper.LOG_SPEED, 9.0, (0.0, 0.0)))
+
+    def test_truncated(self):
+        for cut in range(len(self.data) + 1):
+            with open(self.path, 'wb') as f:
+                f.write(self.data[:cut])
+            if cut < len(Mapper.LOG_MAGIC):
+                self.assertRaises(ValueError, list, Mapper.read_log(self.path))
+                continue
+            complete = len([end for end in self.ends if end <= cut])
+            self.assertEqual([record[:2] for record in Mapper.read_log(self.path)],
+                             [record[:2] for record in self.records[:complete]], 'cut at %d' % cut)
+            if Mapper.np is not None:
+                timestamps, positions, headings = Mapper.read_poses(self.path)
+                self.assertEqual(len(timestamps), len([r for r in self.records[:complete] if r[0] == Mapper.LOG_POSE]))
+
+    @unittest.skipIf(Mapper.np is None, 'read_poses needs numpy')
+    def test_read_poses(self):
+        timestamps, positions, headings = Mapper.read_poses(self.path)
+        poses = [(timestamp, Mapper.pose2d.from_lokarria(data)) for kind, timestamp, data in self.records
+                 if kind == Mapper.LOG_POSE]
+        self.assertEqual(timestamps.tolist(), [timestamp for timestamp, p in poses])
+        self.assertEqual(positions.tolist(), [[p.x, p.y] for timestamp, p in poses])
+        for heading, (timestamp, p) in zip(headings, poses):
+            self.assertAlmostEqual(heading, p.yaw)
+
+    def test_not_a_log(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'MLOG\x02' + b'\x00' * 16)
+        self.assertRaises(ValueError, list, Mapper.read_log(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()